@@ -69,6 +69,9 @@ from termcolor import colored
 
 __version__ = '0.14.1+git'
 
+# content type of a streamed `apps:run` response from the controller
+RUN_STREAM_CONTENT_TYPE = 'application/vnd.deis.run-stream'
+
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -373,7 +376,7 @@ class DeisClient(object):
         self._settings = Settings()
         self._logger = logging.getLogger(__name__)
 
-    def _dispatch(self, method, path, body=None, **kwargs):
+    def _dispatch(self, method, path, body=None, stream=False, **kwargs):
         """
         Dispatch an API request to the active Deis controller
         """
@@ -389,9 +392,43 @@ class DeisClient(object):
             'X-Deis-Version': __version__.rsplit('.', 1)[0],
             'Authorization': 'token {}'.format(token)
         }
-        response = func(url, data=body, headers=headers)
+        response = func(url, data=body, headers=headers, stream=stream)
         return response
 
+    def _wait_for_job(self, app, response):
+        """
+        Wait for the job of an accepted request to finish.
+
+        Controllers may queue scales and deploys and answer 202 Accepted with the
+        job running them in the background. Gives up after DEIS_JOB_TIMEOUT
+        seconds (default: 1200), leaving the job to finish on its own.
+        """
+        if response.status_code != requests.codes.accepted:
+            return
+        job = response.headers.get('x-deis-job')
+        if not job:
+            data = response.json()
+            job = data.get('job') or data['uuid']
+        deadline = time.time() + float(os.environ.get('DEIS_JOB_TIMEOUT', 1200))
+        while True:
+            if time.time() > deadline:
+                raise EnvironmentError(
+                    'Timed out waiting for job {}; check its state with '
+                    '`GET /v1/apps/{}/jobs/{}`'.format(job, app, job))
+            time.sleep(1)
+            job_response = self._dispatch('get', "/v1/apps/{}/jobs/{}".format(app, job))
+            if job_response.status_code != requests.codes.ok:
+                raise ResponseError(job_response)
+            data = job_response.json()
+            if data['state'] == 'succeeded':
+                return
+            if data['state'] == 'superseded':
+                # merged into a later job, which does the work
+                job = data['params']['superseded_by']
+                continue
+            if data['state'] == 'failed':
+                raise EnvironmentError(data['error'])
+
     def apps(self, args):
         """
         Valid commands for apps:
@@ -642,11 +679,22 @@ class DeisClient(object):
         app = args.get('--app')
         if not app:
             app = self._session.app
-        body = {'command': command}
+        body = {'command': command, 'stream': True}
         response = self._dispatch('post',
                                   "/v1/apps/{}/run".format(app),
-                                  json.dumps(body))
-        if response.status_code == requests.codes.ok:
+                                  json.dumps(body), stream=True)
+        if response.status_code == requests.codes.ok and \
+                response.headers.get('content-type') == RUN_STREAM_CONTENT_TYPE:
+            trailer = {}
+            for chunk in self._read_run_stream(response.raw, trailer):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+            if 'error' in trailer:
+                self._logger.error(trailer['error'])
+                sys.exit(1)
+            sys.exit(trailer['rc'])
+        elif response.status_code == requests.codes.ok:
+            # controllers without streaming support reply with all output at once
             rc, output = json.loads(response.content)
             sys.stdout.write(output)
             sys.stdout.flush()
@@ -654,6 +702,32 @@ class DeisClient(object):
         else:
             raise ResponseError(response)
 
+    def _read_run_stream(self, raw, trailer):
+        """
+        Yield the output chunks of a streamed `apps:run` response as they arrive.
+
+        Each chunk is framed by its length in hex and a newline; a zero-length
+        frame is followed by a JSON trailer, which is read into `trailer`.
+        """
+        while True:
+            header = ''
+            while not header.endswith('\n'):
+                char = raw.read(1)
+                if not char:
+                    raise EnvironmentError('Connection closed while running command')
+                header += char
+            size = int(header, 16)
+            if size == 0:
+                break
+            chunk = ''
+            while len(chunk) < size:
+                data = raw.read(size - len(chunk))
+                if not data:
+                    raise EnvironmentError('Connection closed while running command')
+                chunk += data
+            yield chunk
+        trailer.update(json.loads(raw.read()))
+
     def auth(self, args):
         """
         Valid commands for auth:
@@ -881,10 +955,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', "/v1/apps/{}/builds".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}".format(version))
         else:
@@ -996,10 +1071,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', "/v1/apps/{}/config".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}\n".format(version))
             config = response.json()
@@ -1042,10 +1118,11 @@ class DeisClient(object):
             progress.start()
             response = self._dispatch(
                 'post', "/v1/apps/{}/config".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}\n".format(version))
             config = response.json()
@@ -1299,10 +1376,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', "/v1/apps/{}/config".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}\n".format(version))
 
@@ -1345,10 +1423,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', "/v1/apps/{}/config".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}\n".format(version))
             self._print_limits(app, response.json())
@@ -1449,10 +1528,11 @@ class DeisClient(object):
             response = self._dispatch('post',
                                       "/v1/apps/{}/scale".format(app),
                                       json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.no_content:
+        if response.status_code in (requests.codes.no_content, requests.codes.accepted):
             self._logger.info('done in {}s'.format(int(time.time() - before)))
             self.ps_list({}, app)
         else:
@@ -1519,10 +1599,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', "/v1/apps/{}/config".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}\n".format(version))
 
@@ -1557,10 +1638,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', "/v1/apps/{}/config".format(app), json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             version = response.headers['x-deis-release']
             self._logger.info("done, v{}\n".format(version))
             self._print_tags(app, response.json())
@@ -1919,10 +2001,11 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             response = self._dispatch('post', url, json.dumps(body))
+            self._wait_for_job(app, response)
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code == requests.codes.created:
+        if response.status_code in (requests.codes.created, requests.codes.accepted):
             new_version = response.json()['version']
             self._logger.info("done, v{}".format(new_version))
         else:
@@ -0,0 +1,130 @@
+"""
+A bounded, process-wide thread pool for fanning out scheduler calls.
+"""
+
+from __future__ import unicode_literals
+import collections
+import logging
+import sys
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """The pending result of a function submitted to an :class:`Executor`."""
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def wait(self):
+        """Block until the task has run and return its result, or raise its exception."""
+        self._done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class Executor(object):
+    """Run functions on at most `max_workers` threads shared by the whole process.
+
+    At most `max_per_key` tasks submitted under the same key (e.g. an app id) run
+    at once; callers submitting more block until one of them finishes. Worker
+    threads are started on demand and keep taking tasks, reusing one database
+    connection, until there is no more work coming; they close the connection
+    as they exit.
+    """
+
+    def __init__(self, max_workers, max_per_key=None):
+        self.max_workers = max_workers
+        self.max_per_key = max_per_key or max_workers
+        self._tasks = collections.deque()
+        self._lock = threading.Condition(threading.Lock())
+        self._workers = 0
+        self._idle = 0
+        self._waiting = 0
+        self._running = collections.Counter()
+
+    def submit(self, key, fn, *args):
+        """Schedule ``fn(*args)`` under `key` and return its :class:`Task`."""
+        task = Task(fn, args)
+        with self._lock:
+            self._waiting += 1
+            while self._running[key] >= self.max_per_key:
+                self._lock.wait()
+            self._waiting -= 1
+            self._running[key] += 1
+            self._tasks.append((key, task))
+            if self._idle == 0 and self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work, name='executor')
+                worker.daemon = True
+                worker.start()
+            else:
+                self._lock.notify_all()
+        return task
+
+    def map(self, key, fn, items):
+        """Run ``fn(item)`` for each item under `key` and wait for them all.
+
+        Returns the tasks in the order of `items`; errors are left on the tasks
+        for the caller to inspect.
+        """
+        tasks = [self.submit(key, fn, item) for item in items]
+        for task in tasks:
+            task._done.wait()
+        return tasks
+
+    def _work(self):
+        try:
+            while True:
+                with self._lock:
+                    # a blocked submitter is about to hand over more work
+                    while not self._tasks and self._waiting:
+                        self._idle += 1
+                        self._lock.wait()
+                        self._idle -= 1
+                    if not self._tasks:
+                        self._workers -= 1
+                        return
+                    key, task = self._tasks.popleft()
+                task.run()
+                if task.exc_info is not None:
+                    logger.debug('task failed', exc_info=task.exc_info)
+                with self._lock:
+                    self._running[key] -= 1
+                    if not self._running[key]:
+                        del self._running[key]
+                    self._lock.notify_all()
+                task._done.set()
+        finally:
+            # the connection of this thread is not used again
+            connection.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the executor shared by all requests in this process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor(settings.SCHEDULER_CONCURRENCY,
+                                 settings.SCHEDULER_APP_CONCURRENCY)
+        return _executor
@@ -0,0 +1,109 @@
+"""
+Run the scale and deploy jobs queued by the API when ASYNC_JOBS is set.
+"""
+
+from __future__ import unicode_literals
+import logging
+import multiprocessing
+from optparse import make_option
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from api.models import Job
+from api.reconciler import start_reconciler
+
+
+logger = logging.getLogger(__name__)
+
+
+def _work(interval):
+    """Claim and run jobs until terminated, sleeping `interval` seconds when idle."""
+    # don't share the parent's database connection
+    connection.close()
+    while True:
+        if not _work_once():
+            time.sleep(interval)
+
+
+def _work_once():
+    """
+    Claim and run one job, returning False if there was none to claim.
+
+    Errors are logged rather than raised so that a lost database connection or
+    a bug in one job does not take the worker process down.
+    """
+    try:
+        job = Job.claim()
+    except Exception:
+        logger.exception('failed to claim a job')
+        connection.close()
+        return False
+    if job is None:
+        return False
+    logger.info('running job {}'.format(job))
+    try:
+        job.run()
+    except Exception as e:
+        logger.exception('job {} failed'.format(job))
+        # the connection may be what failed; reconnect to record the outcome
+        connection.close()
+        try:
+            Job.objects.filter(pk=job.pk, state=Job.RUNNING).update(
+                state=Job.FAILED, error=str(e), finished=timezone.now())
+        except Exception:
+            logger.exception('failed to mark job {} as failed'.format(job))
+            connection.close()
+    return True
+
+
+class Command(BaseCommand):
+    help = 'Runs queued scale and deploy jobs in a pool of worker processes'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers',
+                    help='number of worker processes (default: JOB_WORKERS)'),
+        make_option('--interval', type='float', dest='interval',
+                    help='seconds between polls of an idle worker (default: JOB_POLL_INTERVAL)'),
+    )
+
+    def handle(self, *args, **options):
+        workers = options.get('workers') or settings.JOB_WORKERS
+        if not settings.ASYNC_JOBS:
+            # nothing is ever queued; only run the reconciler
+            workers = 0
+        interval = options.get('interval') or settings.JOB_POLL_INTERVAL
+        # jobs left running by a previous worker will never finish
+        Job.objects.filter(state=Job.RUNNING).update(
+            state=Job.FAILED, error='interrupted by a restart of the job worker')
+        connection.close()
+        processes = [self._spawn(interval) for _ in range(workers)]
+        signal.signal(signal.SIGTERM, lambda *args: self._stop(processes))
+        if settings.RECONCILE_INTERVAL:
+            start_reconciler(settings.RECONCILE_INTERVAL)
+        self.stdout.write('job worker running with {} processes'.format(workers))
+        try:
+            while True:
+                time.sleep(interval)
+                # replace workers that died so the pool keeps its size
+                for i, p in enumerate(processes):
+                    if not p.is_alive():
+                        logger.warning('job worker {} exited with code {}, respawning'.format(
+                            p.pid, p.exitcode))
+                        processes[i] = self._spawn(interval)
+        except KeyboardInterrupt:
+            self._stop(processes)
+
+    def _spawn(self, interval):
+        p = multiprocessing.Process(target=_work, args=(interval,), name='jobworker')
+        p.daemon = True
+        p.start()
+        return p
+
+    def _stop(self, processes):
+        for p in processes:
+            p.terminate()
+        raise SystemExit(0)
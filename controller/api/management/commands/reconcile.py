@@ -0,0 +1,30 @@
+"""
+Correct the state of containers that changed behind the API's back.
+"""
+
+from __future__ import unicode_literals
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.reconciler import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Reconciles the state of containers with the scheduler'
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', dest='interval',
+                    help='keep reconciling every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        interval = options.get('interval')
+        while True:
+            corrected = reconcile()
+            self.stdout.write('corrected the state of {} containers'.format(corrected))
+            if not interval:
+                return
+            connection.close()
+            time.sleep(interval)
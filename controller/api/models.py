@@ -5,22 +5,22 @@ Data models for the Deis API.
 """
 
 from __future__ import unicode_literals
+import contextlib
 import etcd
-import importlib
 import logging
 import os
 import re
 import subprocess
-import time
 import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Max
+from django.db import connection, models, transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django_fsm import FSMField, transition
 from django_fsm.signals import post_transition
@@ -30,12 +30,25 @@ import requests
 from rest_framework.authtoken.models import Token
 
 from api import fields
+from api.executor import get_executor
 from registry import publish_release
+import scheduler
+from scheduler.metrics import InstrumentedSchedulerClient
 from utils import dict_diff, fingerprint
 
 
 logger = logging.getLogger(__name__)
 
+DEPLOY_STRATEGIES = ('batch', 'pipelined', 'rolling')
+
+
+class PartialDeployError(RuntimeError):
+    """A deploy stopped after some containers were moved to the new release.
+
+    Unlike other deploy failures, the release is kept, since those containers
+    run it.
+    """
+
 
 def log_event(app, msg, level=logging.INFO):
     msg = "{}: {}".format(app.id, msg)
@@ -43,6 +56,20 @@ def log_event(app, msg, level=logging.INFO):
     app.log(msg)            # local filesystem
 
 
+def get_scheduler():
+    """Return the client of the configured scheduler, shared by the whole process."""
+    return scheduler.get_client(settings.SCHEDULER_MODULE,
+                                settings.SCHEDULER_TARGET,
+                                settings.SCHEDULER_AUTH,
+                                settings.SCHEDULER_OPTIONS,
+                                settings.SSH_PRIVATE_KEY,
+                                wrap=_instrument)
+
+
+def _instrument(client):
+    return InstrumentedSchedulerClient(client, share_url=settings.SCHEDULER_METRICS_URL)
+
+
 def validate_app_structure(value):
     """Error if the dict values aren't ints >= 0."""
     try:
@@ -53,6 +80,30 @@ def validate_app_structure(value):
         raise ValidationError(err)
 
 
+def validate_rollout(value):
+    """Error if the deploy settings of an app are unknown or out of range."""
+    unknown = set(value) - set(['strategy', 'max_surge', 'max_unavailable'])
+    if unknown:
+        raise ValidationError('Unknown deploy settings: {}'.format(', '.join(sorted(unknown))))
+    if value.get('strategy', 'rolling') not in DEPLOY_STRATEGIES:
+        raise ValidationError('Deploy strategy must be one of {}'.format(
+            ', '.join(DEPLOY_STRATEGIES)))
+    try:
+        surge, unavailable = _rollout_limits(value)
+    except (TypeError, ValueError):
+        raise ValidationError('max_surge and max_unavailable must be integers')
+    if surge < 0 or unavailable < 0:
+        raise ValidationError('max_surge and max_unavailable must not be negative')
+    if surge + unavailable < 1:
+        raise ValidationError('max_surge and max_unavailable cannot both be zero')
+
+
+def _rollout_limits(rollout):
+    """Return the max_surge and max_unavailable of a rolling deploy."""
+    return (int(rollout.get('max_surge', settings.DEPLOY_MAX_SURGE)),
+            int(rollout.get('max_unavailable', settings.DEPLOY_MAX_UNAVAILABLE)))
+
+
 def validate_comma_separated(value):
     """Error if the value doesn't look like a list of hostnames or IP addresses
     separated by commas.
@@ -98,6 +149,7 @@ class App(UuidAuditedModel):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL)
     id = models.SlugField(max_length=64, unique=True)
     structure = JSONField(default={}, blank=True, validators=[validate_app_structure])
+    rollout = JSONField(default={}, blank=True, validators=[validate_rollout])
 
     class Meta:
         permissions = (('use_app', 'Can use app'),)
@@ -106,13 +158,7 @@ class App(UuidAuditedModel):
         return self.id
 
     def _get_scheduler(self, *args, **kwargs):
-        module_name = 'scheduler.' + settings.SCHEDULER_MODULE
-        mod = importlib.import_module(module_name)
-
-        return mod.SchedulerClient(settings.SCHEDULER_TARGET,
-                                   settings.SCHEDULER_AUTH,
-                                   settings.SCHEDULER_OPTIONS,
-                                   settings.SSH_PRIVATE_KEY)
+        return get_scheduler()
 
     _scheduler = property(_get_scheduler)
 
@@ -140,7 +186,7 @@ class App(UuidAuditedModel):
 
     def delete(self, *args, **kwargs):
         """Delete this application including all containers"""
-        for c in self.container_set.exclude(type='run'):
+        for c in self._bind(list(self.container_set.exclude(type='run'))):
             c.destroy()
         self._clean_app_logs()
         return super(App, self).delete(*args, **kwargs)
@@ -151,31 +197,103 @@ class App(UuidAuditedModel):
         if os.path.exists(path):
             os.remove(path)
 
-    def scale(self, user, structure):  # noqa
-        """Scale containers up or down to match requested structure."""
-        if self.release_set.latest().build is None:
+    def _latest_release(self):
+        """Return the latest release, with its config and build loaded in the same query."""
+        release = self.release_set.select_related('config', 'build').latest()
+        release.app = self
+        return release
+
+    def _bind(self, containers, *releases):
+        """
+        Hand this app and their releases to `containers`, and return them.
+
+        Each release is loaded once, with its config and build, and shared by all
+        of its containers, so scheduling them does not query for those again per
+        container. `releases` that are already loaded are used as they are.
+        """
+        known = dict((r.pk, r) for r in releases)
+        missing = set(c.release_id for c in containers) - set(known)
+        if missing:
+            known.update(Release.objects.select_related('config', 'build').in_bulk(missing))
+        for release in known.values():
+            release.app = self
+        for c in containers:
+            c.app = self
+            c.release = known[c.release_id]
+        return containers
+
+    def _check_structure(self, structure):
+        """Raise EnvironmentError unless the latest release can be scaled to `structure`.
+
+        Returns the latest release.
+        """
+        release = self._latest_release()
+        if release.build is None:
             raise EnvironmentError('No build associated with this release')
-        requested_structure = structure.copy()
-        release = self.release_set.latest()
         # test for available process types
         available_process_types = release.build.procfile or {}
-        for container_type in requested_structure.keys():
+        for container_type in structure:
             if container_type == 'cmd':
                 continue  # allow docker cmd types in case we don't have the image source
             if container_type not in available_process_types:
                 raise EnvironmentError(
                     'Container type {} does not exist in application'.format(container_type))
+        return release
+
+    def scale(self, user, structure):
+        """
+        Scale containers up or down to match requested structure.
+
+        Scales and deploys of an app run one at a time; see :func:`app_lock`.
+        Scales requested in this process while waiting for their turn are
+        merged, later counts overriding earlier ones, and applied at once by
+        whichever of them gets the lock first; each of them returns or raises
+        what that scale did. Scales waiting in other processes run after it.
+        """
+        self._check_structure(structure)
+        with _app_locks_guard:
+            pending = _pending_scales.setdefault(
+                self.pk, {'structure': {}, 'changed': None, 'error': None})
+            pending['structure'].update(structure)
+        with app_lock(self):
+            with _app_locks_guard:
+                run = _pending_scales.get(self.pk) is pending
+                if run:
+                    del _pending_scales[self.pk]
+            if run:
+                try:
+                    pending['changed'] = self._scale(user, pending['structure'])
+                except Exception as e:
+                    pending['error'] = e
+                    raise
+        # another request applied the merged structure while this one waited
+        if pending['error'] is not None:
+            raise pending['error']
+        return pending['changed']
+
+    def _scale(self, user, structure):  # noqa
+        # check again, as a deploy may have run while waiting
+        release = self._check_structure(structure)
+        requested_structure = structure.copy()
         msg = '{} scaled containers '.format(user.username) + ' '.join(
             "{}={}".format(k, v) for k, v in requested_structure.items())
         log_event(self, msg)
+        # fetch the containers of every requested type at once
+        existing = {}
+        queryset = self.container_set.filter(type__in=requested_structure.keys())
+        current, stale = self._split_stale(
+            self._bind(list(queryset.order_by('created')), release))
+        for c in current:
+            existing.setdefault(c.type, []).append(c)
+        if stale:
+            self._retire_containers(stale)
         # iterate and scale by container type (web, worker, etc)
         changed = False
         to_add, to_remove = [], []
         for container_type in requested_structure.keys():
-            containers = list(self.container_set.filter(type=container_type).order_by('created'))
+            containers = existing.get(container_type, [])
             # increment new container nums off the most recent container
-            results = self.container_set.filter(type=container_type).aggregate(Max('num'))
-            container_num = (results.get('num__max') or 0) + 1
+            container_num = max([c.num for c in containers] or [0]) + 1
             requested = requested_structure.pop(container_type)
             diff = requested - len(containers)
             if diff == 0:
@@ -186,15 +304,17 @@ class App(UuidAuditedModel):
                 to_remove.append(c)
                 diff += 1
             while diff > 0:
-                # create a database record
-                c = Container.objects.create(owner=self.owner,
-                                             app=self,
-                                             release=release,
-                                             type=container_type,
-                                             num=container_num)
-                to_add.append(c)
+                to_add.append(Container(owner=self.owner,
+                                        app=self,
+                                        release=release,
+                                        type=container_type,
+                                        num=container_num))
                 container_num += 1
                 diff -= 1
+        # create the database records in one go
+        if to_add:
+            with transaction.atomic():
+                Container.objects.bulk_create(to_add)
         if changed:
             if to_add:
                 self._start_containers(to_add)
@@ -205,53 +325,160 @@ class App(UuidAuditedModel):
         self.save()
         return changed
 
+    def _schedule(self, containers, action):
+        """Apply a scheduler action (create, start or destroy) to each container.
+
+        Schedulers with batch methods (e.g. ``create_many``) get a single call for all
+        containers; otherwise the containers are handed to the process-wide executor,
+        which bounds how many run the action at once.
+        """
+        batch = getattr(self._scheduler, action + '_many', None)
+        if batch is None:
+            # failures are recorded in each container's state
+            get_executor().map(self.id, lambda c: getattr(c, action)(), containers)
+            return
+        if action == 'create':
+            errors = batch([c._create_options() for c in containers])
+        else:
+            errors = batch([c._job_id for c in containers])
+        with coalesce_transitions():
+            for c in containers:
+                try:
+                    getattr(c, action)(errors=errors)
+                except Exception:
+                    pass  # the failure is recorded in the container's state, as with threads
+
     def _start_containers(self, to_add):
         """Creates and starts containers via the scheduler"""
-        create_threads = []
-        start_threads = []
-        for c in to_add:
-            create_threads.append(threading.Thread(target=c.create))
-            start_threads.append(threading.Thread(target=c.start))
-        [t.start() for t in create_threads]
-        [t.join() for t in create_threads]
+        self._schedule(to_add, 'create')
         if set([c.state for c in to_add]) != set([Container.CREATED]):
             err = 'aborting, failed to create some containers'
             log_event(self, err, logging.ERROR)
             raise RuntimeError(err)
-        [t.start() for t in start_threads]
-        [t.join() for t in start_threads]
+        self._schedule(to_add, 'start')
         if set([c.state for c in to_add]) != set([Container.UP]):
             err = 'warning, some containers failed to start'
             log_event(self, err, logging.WARNING)
 
     def _destroy_containers(self, to_destroy):
         """Destroys containers via the scheduler"""
-        destroy_threads = []
-        for c in to_destroy:
-            destroy_threads.append(threading.Thread(target=c.destroy))
-        [t.start() for t in destroy_threads]
-        [t.join() for t in destroy_threads]
+        self._schedule(to_destroy, 'destroy')
         [c.delete() for c in to_destroy if c.state == Container.DESTROYED]
         if set([c.state for c in to_destroy]) != set([Container.DESTROYED]):
             err = 'aborting, failed to destroy some containers'
             log_event(self, err, logging.ERROR)
             raise RuntimeError(err)
 
+    def _split_stale(self, containers):
+        """
+        Split `containers` into the current container of each type and number, and
+        the ones a deploy replaced but could not destroy, which are in the error
+        state and share their type and number with a newer container.
+        """
+        current, stale = {}, []
+        for c in containers:
+            key = (c.type, c.num)
+            other = current.get(key)
+            if other is not None:
+                if c.state == Container.ERROR and other.state != Container.ERROR:
+                    stale.append(c)
+                    continue
+                stale.append(other)
+            current[key] = c
+        return [c for c in containers if current.get((c.type, c.num)) is c], stale
+
+    def _retire_containers(self, old):
+        """
+        Destroy containers that the new release no longer needs.
+
+        Once new containers are serving, a failure here must not fail the deploy,
+        which would remove the release they run; containers that could not be
+        destroyed are left in the error state and reported instead.
+        """
+        self._schedule(old, 'destroy')
+        [c.delete() for c in old if c.state == Container.DESTROYED]
+        if any(c.state != Container.DESTROYED for c in old):
+            log_event(self, 'warning, failed to destroy some containers', logging.ERROR)
+
+    def submit(self, user, action, release=None, **params):
+        """
+        Scale or deploy this application on behalf of a user.
+
+        `action` is "scale", with the new `structure` as a parameter, or "deploy",
+        which deploys `release`. With ASYNC_JOBS set, the action is queued as a
+        :class:`Job` for the job worker and the job is returned; otherwise it is
+        performed right away and None is returned.
+        """
+        job = Job(owner=user, app=self, action=action, release=release, params=params)
+        if not settings.ASYNC_JOBS:
+            job.execute()
+            return None
+        if action == 'scale':
+            # report what we can before the request returns
+            self._check_structure(params['structure'])
+        job.save()
+        return job
+
     def deploy(self, user, release, initial=False):
-        """Deploy a new release to this application"""
-        existing = self.container_set.exclude(type='run')
-        new = []
-        for e in existing:
-            n = e.clone(release)
-            n.save()
-            new.append(n)
+        """
+        Deploy a new release to this application.
+
+        Only containers whose unit would differ under `release` are replaced; see
+        :meth:`Release.changes_unit`. The others keep running, and stay on the
+        release their unit was named after.
+        """
+        with app_lock(self):
+            self._deploy(user, release, initial)
+
+    def _deploy(self, user, release, initial):
+        current, stale = self._split_stale(
+            self._bind(list(self.container_set.exclude(type='run')), release))
+        existing, unchanged, changed = [], set(), {}
+        for c in current:
+            key = (c.release_id, c.type)
+            if key not in changed:
+                changed[key] = c.release.changes_unit(release, c.type)
+            if changed[key]:
+                existing.append(c)
+            else:
+                unchanged.add(c.type)
+        unchanged -= set(c.type for c in existing)
+        if unchanged:
+            log_event(self, 'deploying {}, leaving {} containers untouched'.format(
+                release, ', '.join(sorted(unchanged))))
+        new = [e.clone(release) for e in existing]
+        with transaction.atomic():
+            Container.objects.bulk_create(new)
+
+        strategy = self._deploy_strategy()
+        if strategy == 'rolling':
+            self._deploy_rolling(zip(existing, new), *_rollout_limits(self.rollout))
+        elif strategy == 'pipelined':
+            self._deploy_pipelined(zip(existing, new))
+        else:
+            self._deploy_batch(existing, new)
+        if stale:
+            self._retire_containers(stale)
+
+        # perform default scaling if necessary
+        if initial:
+            self._default_scale(user, release)
+
+    def _deploy_strategy(self):
+        """Return the deploy strategy of this app.
+
+        Apps with their own rollout limits deploy in rolling batches unless they
+        pick another strategy; all others use DEPLOY_STRATEGY.
+        """
+        rollout = self.rollout or {}
+        if 'max_surge' in rollout or 'max_unavailable' in rollout:
+            return rollout.get('strategy', 'rolling')
+        return rollout.get('strategy', settings.DEPLOY_STRATEGY)
 
+    def _deploy_batch(self, existing, new):
+        """Create all new containers, then start them all, then destroy all old ones."""
         # create new containers
-        threads = []
-        for c in new:
-            threads.append(threading.Thread(target=c.create))
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        self._schedule(new, 'create')
 
         # check for containers that failed to create
         if len(new) > 0 and set([c.state for c in new]) != set([Container.CREATED]):
@@ -261,11 +488,7 @@ class App(UuidAuditedModel):
             raise RuntimeError(err)
 
         # start new containers
-        threads = []
-        for c in new:
-            threads.append(threading.Thread(target=c.start))
-        [t.start() for t in threads]
-        [t.join() for t in threads]
+        self._schedule(new, 'start')
 
         # check for containers that didn't come up correctly
         if len(new) > 0 and set([c.state for c in new]) != set([Container.UP]):
@@ -275,11 +498,114 @@ class App(UuidAuditedModel):
 
         # destroy old containers
         if existing:
-            self._destroy_containers(existing)
-
-        # perform default scaling if necessary
-        if initial:
-            self._default_scale(user, release)
+            self._retire_containers(existing)
+
+    def _deploy_pipelined(self, pairs):
+        """Replace each old container with its new counterpart independently.
+
+        Each new container is created and started as soon as it can be, without
+        waiting for the others. With DEPLOY_ATOMIC, old containers are retired only
+        once every new container was created, and a failure to create any of them
+        rolls the whole deploy back. Otherwise each old container is retired as soon
+        as its replacement has been started, and one whose replacement could not be
+        created keeps running on its release; the deploy then fails, with
+        :class:`PartialDeployError` if any container was replaced.
+        """
+        atomic = settings.DEPLOY_ATOMIC
+
+        def replace(pair):
+            old, new = pair
+            new.create()
+            if new.state != Container.CREATED:
+                return
+            new.start()
+            if not atomic:
+                old.destroy()
+                if old.state == Container.DESTROYED:
+                    old.delete()
+
+        get_executor().map(self.id, replace, pairs)
+        failed = [n for _, n in pairs if n.state not in (Container.UP, Container.CRASHED)]
+        if any(n.state == Container.CRASHED for _, n in pairs):
+            log_event(self, 'warning, some containers failed to start', logging.WARNING)
+        if atomic:
+            if failed:
+                err = 'aborting, failed to create some containers'
+                log_event(self, err, logging.ERROR)
+                self._destroy_containers([n for _, n in pairs])
+                raise RuntimeError(err)
+            if pairs:
+                self._retire_containers([o for o, _ in pairs])
+            return
+        if any(o.state != Container.DESTROYED for o, n in pairs if n not in failed):
+            log_event(self, 'warning, failed to destroy some containers', logging.ERROR)
+        if not failed:
+            return
+        self._retire_containers(failed)
+        err = '{} of {} containers failed to create and were left on their ' \
+            'previous release'.format(len(failed), len(pairs))
+        log_event(self, err, logging.ERROR)
+        if len(failed) == len(pairs):
+            raise RuntimeError('aborting, ' + err)
+        raise PartialDeployError(err)
+
+    def _deploy_rolling(self, pairs, max_surge, max_unavailable):
+        """Replace containers in batches of ``max_surge + max_unavailable``.
+
+        Up to `max_unavailable` old containers of a batch are retired before its
+        replacements are created, and the rest once the batch is up, so at most
+        `max_surge` containers beyond the app's structure ever run and at most
+        `max_unavailable` fewer than it are in service. If a batch fails, the
+        containers it retired early are brought back on their release, and the
+        rollout stops there with the remaining containers on their release; past
+        the first batch, this raises :class:`PartialDeployError`.
+        """
+        size = max_surge + max_unavailable
+        for i in range(0, len(pairs), size):
+            old = [o for o, _ in pairs[i:i + size]]
+            new = [n for _, n in pairs[i:i + size]]
+            # before the first batch is up, failures still abort the whole deploy
+            destroy = self._retire_containers if i else self._destroy_containers
+            retired = old[:max_unavailable]
+            if retired:
+                try:
+                    destroy(retired)
+                except RuntimeError:
+                    self._restore_containers(retired)
+                    [n.delete() for _, n in pairs[i:]]
+                    raise
+            self._schedule(new, 'create')
+            if set([c.state for c in new]) != set([Container.CREATED]):
+                err = 'aborting, failed to create some containers'
+                log_event(self, err, logging.ERROR)
+                try:
+                    destroy(new)
+                finally:
+                    self._restore_containers(retired)
+                [n.delete() for _, n in pairs[i + size:]]
+                if i == 0:
+                    raise RuntimeError(err)
+                err = 'rollout stopped after replacing {} of {} containers'.format(
+                    i, len(pairs))
+                log_event(self, err, logging.ERROR)
+                raise PartialDeployError(err)
+            self._schedule(new, 'start')
+            if set([c.state for c in new]) != set([Container.UP]):
+                log_event(self, 'warning, some containers failed to start', logging.WARNING)
+            if old[max_unavailable:]:
+                self._retire_containers(old[max_unavailable:])
+
+    def _restore_containers(self, retired):
+        """Recreate destroyed containers on their own release, as they were."""
+        restored = [c.clone(c.release) for c in retired if c.state == Container.DESTROYED]
+        if not restored:
+            return
+        with transaction.atomic():
+            Container.objects.bulk_create(restored)
+        try:
+            self._start_containers(restored)
+        except RuntimeError:
+            log_event(self, 'failed to restore some retired containers', logging.ERROR)
 
     def _default_scale(self, user, release):
         """Scale to default structure based on release type"""
@@ -311,11 +637,25 @@ class App(UuidAuditedModel):
 
     def run(self, user, command):
         """Run a one-off command in an ephemeral app container."""
+        c, escaped_command = self._prepare_run(user, command)
+        return c.run(escaped_command)
+
+    def run_stream(self, user, command):
+        """
+        Run a one-off command in an ephemeral app container, streaming its output.
+
+        Returns an iterator of output chunks followed by the integer exit code.
+        """
+        c, escaped_command = self._prepare_run(user, command)
+        return c.run_stream(escaped_command)
+
+    def _prepare_run(self, user, command):
         # FIXME: remove the need for SSH private keys by using
         # a scheduler that supports one-off admin tasks natively
         if not settings.SSH_PRIVATE_KEY:
             raise EnvironmentError('Support for admin commands is not configured')
-        if self.release_set.latest().build is None:
+        release = self._latest_release()
+        if release.build is None:
             raise EnvironmentError('No build associated with this release to run this command')
         # TODO: add support for interactive shell
         msg = "{} runs '{}'".format(user.username, command)
@@ -325,7 +665,7 @@ class App(UuidAuditedModel):
         # create database record for run process
         c = Container.objects.create(owner=self.owner,
                                      app=self,
-                                     release=self.release_set.latest(),
+                                     release=release,
                                      type='run',
                                      num=c_num)
         image = c.release.image
@@ -341,7 +681,7 @@ class App(UuidAuditedModel):
                                       image)
         # SECURITY: shell-escape user input
         escaped_command = command.replace("'", "'\\''")
-        return c.run(escaped_command)
+        return c, escaped_command
 
 
 @python_2_unicode_compatible
@@ -410,36 +750,50 @@ class Container(UuidAuditedModel):
     _command = property(_get_command)
 
     def clone(self, release):
-        c = Container.objects.create(owner=self.owner,
-                                     app=self.app,
-                                     release=release,
-                                     type=self.type,
-                                     num=self.num)
+        """Return an unsaved copy of this container for `release`."""
+        c = Container(owner=self.owner,
+                      app=self.app,
+                      release=release,
+                      type=self.type,
+                      num=self.num)
         return c
 
+    def _create_options(self):
+        """Return the keyword arguments used to create this container."""
+        return {'name': self._job_id,
+                'image': self.release.image,
+                'command': self._command,
+                'memory': self.release.config.memory,
+                'cpu': self.release.config.cpu,
+                'tags': self.release.config.tags}
+
+    def _check_batch(self, errors):
+        """Raise the error a batch scheduler call reported for this container, if any."""
+        error = errors.get(self._job_id)
+        if error:
+            raise error
+
     @transition(field=state, source=INITIALIZED, target=CREATED, on_error=ERROR)
-    def create(self):
-        image = self.release.image
-        kwargs = {'memory': self.release.config.memory,
-                  'cpu': self.release.config.cpu,
-                  'tags': self.release.config.tags}
+    def create(self, errors=None):
         job_id = self._job_id
         try:
-            self._scheduler.create(
-                name=job_id,
-                image=image,
-                command=self._command,
-                **kwargs)
+            if errors is None:
+                self._scheduler.create(**self._create_options())
+            else:
+                self._check_batch(errors)
         except Exception as e:
             err = '{} (create): {}'.format(job_id, e)
             log_event(self.app, err, logging.ERROR)
             raise
 
     @transition(field=state, source=[CREATED, UP, DOWN], target=UP, on_error=CRASHED)
-    def start(self):
+    def start(self, errors=None):
         job_id = self._job_id
         try:
-            self._scheduler.start(job_id)
+            if errors is None:
+                self._scheduler.start(job_id)
+            else:
+                self._check_batch(errors)
         except Exception as e:
             err = '{} (start): {}'.format(job_id, e)
             log_event(self.app, err, logging.WARNING)
@@ -456,10 +810,13 @@ class Container(UuidAuditedModel):
             raise
 
     @transition(field=state, source='*', target=DESTROYED, on_error=ERROR)
-    def destroy(self):
+    def destroy(self, errors=None):
         job_id = self._job_id
         try:
-            self._scheduler.destroy(job_id)
+            if errors is None:
+                self._scheduler.destroy(job_id)
+            else:
+                self._check_batch(errors)
         except Exception as e:
             err = '{} (destroy): {}'.format(job_id, e)
             log_event(self.app, err, logging.ERROR)
@@ -467,24 +824,56 @@ class Container(UuidAuditedModel):
 
     def run(self, command):
         """Run a one-off command"""
+        image, entrypoint, command = self._run_args(command)
+        job_id = self._job_id
+        try:
+            rc, output = self._scheduler.run(job_id, image, entrypoint, command)
+            return rc, output
+        except Exception as e:
+            err = '{} (run): {}'.format(job_id, e)
+            log_event(self.app, err, logging.ERROR)
+            raise
+
+    def run_stream(self, command):
+        """
+        Run a one-off command, yielding output chunks and then the exit code.
+
+        Schedulers without support for streaming run the command to completion
+        and yield its output as a single chunk.
+        """
+        image, entrypoint, command = self._run_args(command)
+        job_id = self._job_id
+        run_stream = getattr(self._scheduler, 'run_stream', None)
+        if run_stream is None:
+            def run_stream(*args):
+                rc, output = self._scheduler.run(*args)
+                yield output
+                yield rc
+
+        def _stream():
+            # close the scheduler's stream too if the caller stops early
+            with contextlib.closing(run_stream(job_id, image, entrypoint, command)) as items:
+                try:
+                    for item in items:
+                        yield item
+                except Exception as e:
+                    err = '{} (run): {}'.format(job_id, e)
+                    log_event(self.app, err, logging.ERROR)
+                    raise
+        return _stream()
+
+    def _run_args(self, command):
         if self.release.build is None:
             raise EnvironmentError('No build associated with this release '
                                    'to run this command')
         image = self.release.image
-        job_id = self._job_id
         entrypoint = '/bin/bash'
         if self.release.build.procfile:
             entrypoint = '/runner/init'
             command = "'{}'".format(command)
         else:
             command = "-c '{}'".format(command)
-        try:
-            rc, output = self._scheduler.run(job_id, image, entrypoint, command)
-            return rc, output
-        except Exception as e:
-            err = '{} (run): {}'.format(job_id, e)
-            log_event(self.app, err, logging.ERROR)
-            raise
+        return image, entrypoint, command
 
 
 @python_2_unicode_compatible
@@ -533,7 +922,12 @@ class Build(UuidAuditedModel):
         unique_together = (('app', 'uuid'),)
 
     def create(self, user, *args, **kwargs):
-        latest_release = self.app.release_set.latest()
+        """
+        Release and deploy this build.
+
+        Returns the new release and the :class:`Job` deploying it, if any.
+        """
+        latest_release = self.app._latest_release()
         source_version = 'latest'
         if self.sha:
             source_version = 'git-{}'.format(self.sha)
@@ -542,12 +936,8 @@ class Build(UuidAuditedModel):
                                          config=latest_release.config,
                                          source_version=source_version)
         initial = True if self.app.structure == {} else False
-        try:
-            self.app.deploy(user, new_release, initial=initial)
-            return new_release
-        except RuntimeError:
-            new_release.delete()
-            raise
+        job = self.app.submit(user, 'deploy', release=new_release, initial=initial)
+        return new_release, job
 
     def __str__(self):
         return "{0}-{1}".format(self.app.id, self.uuid[:7])
@@ -604,12 +994,13 @@ class Release(UuidAuditedModel):
     def image(self):
         return '{}:v{}'.format(self.app.id, str(self.version))
 
-    def new(self, user, config, build, summary=None, source_version='latest'):
+    def new(self, user, config, build, summary=None, source_version='latest', source=None):
         """
         Create a new application release using the provided Build and Config
         on behalf of a user.
 
-        Releases start at v1 and auto-increment.
+        Releases start at v1 and auto-increment. `source` may name a published
+        release with the same build and config to publish the new one from.
         """
         # construct fully-qualified target image
         new_version = self.version + 1
@@ -618,16 +1009,30 @@ class Release(UuidAuditedModel):
             owner=user, app=self.app, config=config,
             build=build, version=new_version, summary=summary)
         try:
-            release.publish()
+            release.publish(source=source)
         except EnvironmentError as e:
             # If we cannot publish this app, just log and carry on
             logger.info(e)
             pass
         return release
 
-    def publish(self, source_version='latest'):
+    def publish(self, source_version='latest', source=None):
+        """
+        Publish the image of this release to the registry.
+
+        With a `source` release of the same build and config, its image is reused
+        and only the release name in its environment changes, which saves fetching
+        and reworking the build's image. If that image cannot be found, the
+        release is published from its build as usual.
+        """
         if self.build is None:
             raise EnvironmentError('No build associated with this release to publish')
+        if source is not None:
+            try:
+                publish_release(source.image, {}, self.image)
+                return
+            except RuntimeError as e:
+                logger.info('{}: could not publish from {}: {}'.format(self, source, e))
         source_tag = 'git-{}'.format(self.build.sha) if self.build.sha else source_version
         source_image = '{}:{}'.format(self.build.image, source_tag)
         # IOW, this image did not come from the builder
@@ -653,6 +1058,25 @@ class Release(UuidAuditedModel):
                         self.config.values,
                         self.image)
 
+    def changes_unit(self, other, container_type):
+        """
+        Return whether containers of `container_type` would run differently on `other`.
+
+        The image of a release is its build with the config values baked in, so
+        a container only needs replacing when the build, the values, the tags or
+        the limits of its own type differ.
+        """
+        if self.pk == other.pk:
+            return False
+        if self.build_id != other.build_id:
+            return True
+        if self.config_id == other.config_id:
+            return False
+        old, new = self.config, other.config
+        return (old.values != new.values or old.tags != new.tags or
+                old.memory.get(container_type) != new.memory.get(container_type) or
+                old.cpu.get(container_type) != new.cpu.get(container_type))
+
     def previous(self):
         """
         Return the previous Release to this one.
@@ -670,6 +1094,11 @@ class Release(UuidAuditedModel):
         return prev_release
 
     def rollback(self, user, version):
+        """
+        Release and deploy a copy of the given version of the application.
+
+        Returns the new release and the :class:`Job` deploying it, if any.
+        """
         if version < 1:
             raise EnvironmentError('version cannot be below 0')
         summary = "{} rolled back to v{}".format(user, version)
@@ -679,13 +1108,10 @@ class Release(UuidAuditedModel):
             build=prev.build,
             config=prev.config,
             summary=summary,
-            source_version='v{}'.format(version))
-        try:
-            self.app.deploy(user, new_release)
-            return new_release
-        except RuntimeError:
-            new_release.delete()
-            raise
+            source_version='v{}'.format(version),
+            source=prev)
+        job = self.app.submit(user, 'deploy', release=new_release)
+        return new_release, job
 
     def save(self, *args, **kwargs):  # noqa
         if not self.summary:
@@ -756,6 +1182,142 @@ class Release(UuidAuditedModel):
         super(Release, self).save(*args, **kwargs)
 
 
+@python_2_unicode_compatible
+class Job(UuidAuditedModel):
+    """
+    Scale or deploy of an application, run in the background by the job worker
+
+    Jobs are queued by :meth:`App.submit` and claimed one at a time per
+    application by the ``jobworker`` management command.
+    """
+    SCALE = 'scale'
+    DEPLOY = 'deploy'
+    ACTION_CHOICES = (
+        (SCALE, 'scale'),
+        (DEPLOY, 'deploy'),
+    )
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    SUPERSEDED = 'superseded'
+    STATE_CHOICES = (
+        (QUEUED, 'queued'),
+        (RUNNING, 'running'),
+        (SUCCEEDED, 'succeeded'),
+        (FAILED, 'failed'),
+        (SUPERSEDED, 'superseded'),
+    )
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL)
+    app = models.ForeignKey('App')
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    params = JSONField(default={}, blank=True)
+    # a failed deploy removes its release
+    release = models.ForeignKey('Release', null=True, blank=True, on_delete=models.SET_NULL)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=QUEUED)
+    error = models.TextField(blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        get_latest_by = 'created'
+        ordering = ['-created']
+
+    def __str__(self):
+        return "{}-{}-{}".format(self.app.id, self.action, self.uuid[:7])
+
+    @classmethod
+    def claim(cls):
+        """
+        Mark the oldest queued job of an application without a running job as
+        running and return it, or return None if there is nothing to do.
+
+        Claiming is safe across worker processes: only one of them succeeds in
+        moving a job out of the queued state.
+        """
+        busy = cls.objects.filter(state=cls.RUNNING).values('app')
+        skipped = set()
+        queued = cls.objects.filter(state=cls.QUEUED).exclude(app__in=busy)
+        for job in queued.order_by('created'):
+            if job.app_id in skipped:
+                continue
+            now = timezone.now()
+            claimed = cls.objects.filter(pk=job.pk, state=cls.QUEUED).update(
+                state=cls.RUNNING, started=now)
+            if claimed:
+                job.state, job.started = cls.RUNNING, now
+                return job
+            # another worker got here first; leave the rest of this app's jobs to it
+            skipped.add(job.app_id)
+        return None
+
+    def execute(self):
+        """Perform the action of this job, raising any error it fails with."""
+        if self.action == self.SCALE:
+            self.app.scale(self.owner, self.params['structure'])
+            return
+        # load the release with what its containers need, once
+        release = Release.objects.select_related('config', 'build').get(pk=self.release_id)
+        try:
+            self.app.deploy(self.owner, release, initial=self.params.get('initial', False))
+        except PartialDeployError:
+            raise
+        except RuntimeError:
+            self.release.delete()
+            self.release = None
+            raise
+
+    def superseded_by(self):
+        """
+        Return the job queued right after this scale job if it is a scale too,
+        which can apply both structures at once; otherwise return None.
+        """
+        if self.action != self.SCALE:
+            return None
+        later = Job.objects.filter(app=self.app_id, state=self.QUEUED,
+                                   created__gt=self.created).order_by('created')[:1]
+        if later and later[0].action == self.SCALE:
+            return later[0]
+        return None
+
+    def run(self):
+        """Execute a claimed job and record how it ended."""
+        later = self.superseded_by()
+        if later is not None:
+            # hand this structure on; the later job cannot be claimed while this
+            # one is running, and its own counts take precedence
+            structure = dict(self.params['structure'])
+            structure.update(later.params['structure'])
+            later.params['structure'] = structure
+            later.save(update_fields=['params'])
+            log_event(self.app, 'job {} merged into job {}'.format(self.uuid, later.uuid))
+            self.params['superseded_by'] = later.uuid
+            self.state = self.SUPERSEDED
+        else:
+            try:
+                self.execute()
+            except Exception as e:
+                log_event(self.app, 'job {} failed: {}'.format(self.uuid, e), logging.ERROR)
+                self.state, self.error = self.FAILED, str(e)
+            else:
+                self.state = self.SUCCEEDED
+        self.finished = timezone.now()
+        self.save()
+
+    def progress(self):
+        """Count the containers of the job's release by state."""
+        release = self.release
+        if self.action == self.SCALE:
+            release = self.app.release_set.latest()
+        counts = {}
+        if release is not None:
+            containers = self.app.container_set.filter(release=release).exclude(type='run')
+            for state in containers.values_list('state', flat=True):
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+
 @python_2_unicode_compatible
 class Domain(AuditedModel):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL)
@@ -881,13 +1443,84 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
+# state transitions held back by coalesce_transitions(), per thread
+_transitions = threading.local()
+
+
+@contextlib.contextmanager
+def coalesce_transitions():
+    """
+    Hold back the container state transitions made by this thread and write
+    them when the block exits, with one UPDATE per resulting state.
+    """
+    if getattr(_transitions, 'pending', None) is not None:
+        yield  # already coalescing
+        return
+    _transitions.pending = pending = {}
+    try:
+        yield
+    finally:
+        _transitions.pending = None
+        by_state = {}
+        for (model, pk), state in pending.items():
+            by_state.setdefault((model, state), []).append(pk)
+        now = timezone.now()
+        for (model, state), pks in by_state.items():
+            model.objects.filter(pk__in=pks).update(state=state, updated=now)
+
+
+# per-app locks of this process with the number of threads holding or waiting
+# for each, and the scales of each app waiting for its lock
+_app_locks = {}
+_pending_scales = {}
+_app_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def app_lock(app):
+    """
+    Hold the lock that serializes scales and deploys of `app`.
+
+    Threads of this process wait on a lock of their own; on PostgreSQL, a
+    session-level advisory lock keyed by the app extends this to every process
+    sharing the database. Both are reentrant, so a deploy may scale its app.
+    """
+    with _app_locks_guard:
+        entry = _app_locks.setdefault(app.pk, [threading.RLock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            advisory = connection.vendor == 'postgresql'
+            if advisory:
+                key = int(app.pk.replace('-', '')[:15], 16)
+                connection.cursor().execute('SELECT pg_advisory_lock(%s)', [key])
+            try:
+                yield
+            finally:
+                if advisory:
+                    connection.cursor().execute('SELECT pg_advisory_unlock(%s)', [key])
+    finally:
+        # forget the lock of an app nobody is using, so they don't pile up
+        with _app_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _app_locks[app.pk]
+
+
 # save FSM transitions as they happen
 def _save_transition(**kwargs):
-    kwargs['instance'].save()
-    # close database connections after transition
-    # to avoid leaking connections inside threads
-    from django.db import connection
-    connection.close()
+    # only the state changes, so don't rewrite the whole row; the connection
+    # is left open for the next transition and closed when the thread is done
+    instance, model = kwargs['instance'], kwargs['sender']
+    pending = getattr(_transitions, 'pending', None)
+    if pending is not None:
+        pending[(model, instance.pk)] = instance.state
+        return
+    instance.updated = timezone.now()
+    updated = model.objects.filter(pk=instance.pk).update(
+        state=instance.state, updated=instance.updated)
+    if not updated:
+        instance.save()
 
 post_transition.connect(_save_transition)
 
@@ -0,0 +1,83 @@
+"""
+Keep the state of containers in the database in line with the scheduler.
+
+Container state otherwise only changes as the API drives containers through
+their life cycle, so units that crash or vanish later go unnoticed.
+"""
+
+from __future__ import unicode_literals
+import logging
+import threading
+import time
+
+from django.db import connection
+from django.utils import timezone
+
+from api.models import App, Container, get_scheduler, log_event
+
+
+logger = logging.getLogger(__name__)
+
+# states of containers that are settled, and may be corrected; any other state
+# belongs to an operation in progress
+RECONCILED_STATES = (Container.UP, Container.DOWN, Container.CRASHED)
+
+
+def reconcile(scheduler=None):
+    """
+    Correct the state of containers that changed behind the API's back.
+
+    The state of every container is fetched from the scheduler at once and
+    compared with the database, and the corrections are applied with one UPDATE
+    per kind of change. A container the scheduler no longer knows about is
+    marked as crashed. Containers that changed state after the snapshot was
+    taken are left for the next run. Returns the number of containers corrected.
+
+    Schedulers that cannot report the state of all units at once are skipped.
+    """
+    scheduler = scheduler or get_scheduler()
+    if not hasattr(scheduler, 'states'):
+        logger.info('not reconciling, the {} scheduler does not report unit states'.format(
+            type(scheduler).__name__))
+        return 0
+    taken = timezone.now()
+    states = scheduler.states()
+    rows = Container.objects.exclude(type='run').filter(
+        state__in=RECONCILED_STATES, updated__lt=taken)
+    changes, apps = {}, {}
+    for uuid, state, app_id, version, c_type, num in rows.values_list(
+            'uuid', 'state', 'app__id', 'release__version', 'type', 'num').iterator():
+        name = '{}_v{}.{}.{}'.format(app_id, version, c_type, num)
+        actual = states.get(name, Container.CRASHED)
+        if actual is None or actual == state:
+            continue
+        changes.setdefault((state, actual), []).append(uuid)
+        apps.setdefault(app_id, []).append('{}.{} {}'.format(c_type, num, actual))
+    now = timezone.now()
+    for (state, actual), uuids in changes.items():
+        # leave alone containers that an operation moved on in the meantime
+        Container.objects.filter(pk__in=uuids, state=state, updated__lt=taken).update(
+            state=actual, updated=now)
+    for app in App.objects.filter(id__in=apps.keys()):
+        log_event(app, 'containers changed state: {}'.format(', '.join(sorted(apps[app.id]))),
+                  logging.WARNING)
+    return sum(len(uuids) for uuids in changes.values())
+
+
+def _loop(interval):
+    while True:
+        try:
+            reconcile()
+        except Exception:
+            logger.exception('could not reconcile container states')
+        finally:
+            connection.close()
+        time.sleep(interval)
+
+
+def start_reconciler(interval):
+    """Reconcile container states every `interval` seconds in a background thread."""
+    thread = threading.Thread(target=_loop, args=(interval,), name='reconciler')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -9,6 +9,7 @@ import re
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 
 from api import models
@@ -80,6 +81,7 @@ class AppSerializer(serializers.ModelSerializer):
     id = serializers.SlugField(default=utils.generate_app_name)
     url = serializers.Field(source='url')
     structure = JSONFieldSerializer(source='structure', required=False)
+    rollout = JSONFieldSerializer(source='rollout', required=False)
     created = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
     updated = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
 
@@ -87,6 +89,24 @@ class AppSerializer(serializers.ModelSerializer):
         """Metadata options for a :class:`AppSerializer`."""
         model = models.App
 
+    def validate_rollout(self, attrs, source):
+        """
+        Merge new rollout settings into the app's current ones, unsetting null values
+        """
+        if source not in attrs:
+            return attrs
+        new = attrs[source] or {}
+        if not isinstance(new, dict):
+            raise serializers.ValidationError("Rollout settings must be a JSON object")
+        rollout = dict(self.object.rollout if self.object else {})
+        rollout.update(new)
+        attrs[source] = {k: v for k, v in rollout.items() if v is not None}
+        try:
+            models.validate_rollout(attrs[source])
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return attrs
+
     def validate_id(self, attrs, source):
         """
         Check that the ID is all lowercase and not 'deis'
@@ -169,8 +189,32 @@ class ConfigSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError("Tag keys can only contain [a-z]")
             if not re.match(TAGVAL_MATCH, str(v)):
                 raise serializers.ValidationError("Invalid tag value")
+        self._validate_tag_hosts(attrs.get('app'), attrs.get(source, {}))
         return attrs
 
+    def _validate_tag_hosts(self, app, tags):
+        """Reject new tag values that no host in the cluster can satisfy."""
+        metadata = getattr(app._scheduler, 'machine_metadata', None) if app else None
+        if metadata is None:
+            return
+        try:
+            previous = app.config_set.latest().tags or {}
+        except models.Config.DoesNotExist:
+            previous = {}
+        tags = {k: v for k, v in tags.items()
+                if v is not None and (k not in previous or str(previous[k]) != str(v))}
+        if not tags:
+            return
+        try:
+            metadata = metadata()
+        except (RuntimeError, EnvironmentError):
+            # the scheduler is unreachable; let the deploy report the problem
+            return
+        for k, v in tags.items():
+            if v is not None and str(v) not in metadata.get(k, ()):
+                raise serializers.ValidationError(
+                    "No host has the tag {}={}".format(k, v))
+
 
 class ReleaseSerializer(serializers.ModelSerializer):
     """Serialize a :class:`~api.models.Release` model."""
@@ -205,6 +249,28 @@ class ContainerSerializer(serializers.ModelSerializer):
         return "v{}".format(obj.release.version)
 
 
+class JobSerializer(serializers.ModelSerializer):
+    """Serialize a :class:`~api.models.Job` model."""
+
+    owner = serializers.Field(source='owner.username')
+    app = serializers.SlugRelatedField(slug_field='id')
+    release = serializers.SlugRelatedField(slug_field='uuid')
+    params = JSONFieldSerializer(source='params', required=False)
+    progress = serializers.Field(source='progress')
+    created = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
+    updated = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
+    started = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
+    finished = serializers.DateTimeField(format=settings.DEIS_DATETIME_FORMAT, read_only=True)
+
+    class Meta:
+        """Metadata options for a :class:`JobSerializer`."""
+        model = models.Job
+        read_only_fields = ('uuid', 'action', 'state', 'error')
+
+    def transform_release(self, obj, value):
+        return "v{}".format(obj.release.version) if obj.release else None
+
+
 class KeySerializer(serializers.ModelSerializer):
     """Serialize a :class:`~api.models.Key` model."""
 
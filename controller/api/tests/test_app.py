@@ -170,6 +170,42 @@ class AppTest(TestCase):
         self.assertIn('structure', response.data)
         self.assertEqual(response.data['structure'], {"web": 1})
 
+    def test_app_rollout(self):
+        """Rollout settings can be changed, merged and unset."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        self.assertEqual(response.data['rollout'], {})
+        url = '/v1/apps/{}/rollout'.format(app_id)
+        body = {'max_surge': 2}
+        response = self.client.patch(url, json.dumps(body), content_type='application/json',
+                                     HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'max_surge': 2})
+        body = {'max_unavailable': 1}
+        response = self.client.patch(url, json.dumps(body), content_type='application/json',
+                                     HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'max_surge': 2, 'max_unavailable': 1})
+        body = {'max_surge': None}
+        response = self.client.patch(url, json.dumps(body), content_type='application/json',
+                                     HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(App.objects.get(id=app_id).rollout, {'max_unavailable': 1})
+        # reject invalid settings
+        for rollout in ({'max_surge': -1}, {'max_surge': 'lots'}, {'strategy': 'yolo'},
+                        {'max_surge': 0, 'max_unavailable': 0}, {'surge': 1}, ['fast']):
+            response = self.client.patch(url, json.dumps(rollout),
+                                         content_type='application/json',
+                                         HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(App.objects.get(id=app_id).rollout, {'max_unavailable': 1})
+        # the settings are shown with the app
+        url = '/v1/apps/{}'.format(app_id)
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.data['rollout'], {'max_unavailable': 1})
+
     @mock.patch('requests.post', mock_import_repository_task)
     def test_admin_can_manage_other_apps(self):
         """Administrators of Deis should be able to manage all applications.
@@ -10,6 +10,7 @@ from __future__ import unicode_literals
 import json
 import mock
 import requests
+import socket
 
 from django.contrib.auth.models import User
 from django.test import TransactionTestCase
@@ -348,6 +349,47 @@ class ConfigTest(TransactionTestCase):
         return limit4
 
     @mock.patch('requests.post', mock_import_repository_task)
+    @mock.patch('scheduler.mock.MockSchedulerClient.machine_metadata', create=True,
+                return_value={'environ': {'dev', 'prod'}, 'rack': {'1'}})
+    def test_tags_match_hosts(self, mock_metadata):
+        """
+        Test that tags no host can satisfy are rejected
+        """
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/v1/apps/{app_id}/config'.format(**locals())
+        body = {'tags': json.dumps({'environ': 'dev', 'rack': 1})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        body = {'tags': json.dumps({'environ': 'staging'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('No host has the tag environ=staging', response.content)
+        # unsetting a tag needs no matching host
+        body = {'tags': json.dumps({'rack': None})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        # hosts are only looked up for tags that change
+        mock_metadata.reset_mock()
+        for body in ({'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})},
+                     {'tags': json.dumps({'environ': 'dev'})}):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(mock_metadata.call_count, 0)
+        # the check is skipped when the scheduler is unreachable
+        mock_metadata.side_effect = socket.error(2, 'No such file or directory')
+        body = {'tags': json.dumps({'environ': 'staging'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(mock_metadata.call_count, 1)
+
     def test_tags(self):
         """
         Test that tags can be set on an application
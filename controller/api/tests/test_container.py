@@ -9,13 +9,18 @@ from __future__ import unicode_literals
 import json
 import mock
 import requests
+import threading
+import time
 
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django_fsm import TransitionNotAllowed
 from rest_framework.authtoken.models import Token
 
-from api.models import App, Build, Container, Release
+from api import models
+from api.models import App, Build, Container, Release, app_lock, coalesce_transitions
 
 
 def mock_import_repository_task(*args, **kwargs):
@@ -65,6 +70,41 @@ class ContainerTest(TransactionTestCase):
         c.destroy()
         self.assertEqual(c.state, 'destroyed')
 
+    def test_container_state_update(self):
+        """Test that transitions only write the state, coalesced if asked to"""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        build = Build.objects.create(owner=self.user, app=app, image="qwerty")
+        release = Release.objects.create(version=2,
+                                         owner=self.user,
+                                         app=app,
+                                         config=app.config_set.latest(),
+                                         build=build)
+        c1, c2 = [Container.objects.create(owner=self.user,
+                                           app=app,
+                                           release=release,
+                                           type='web',
+                                           num=num) for num in (1, 2)]
+        with CaptureQueriesContext(connection) as queries:
+            c1.create()
+        updates = [q['sql'] for q in queries if 'UPDATE' in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('UPDATE "api_container" SET "state"', updates[0])
+        self.assertNotIn('"num"', updates[0])
+        self.assertEqual(Container.objects.get(pk=c1.pk).state, 'created')
+        # coalesced transitions are written when the block exits
+        with CaptureQueriesContext(connection) as queries:
+            with coalesce_transitions():
+                c2.create()
+                c1.start()
+                c2.start()
+                self.assertEqual(len(queries), 0)
+        updates = [q['sql'] for q in queries if 'UPDATE' in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(set(app.container_set.values_list('state', flat=True)), {'up'})
+
     def test_container_state_protected(self):
         """Test that you cannot directly modify the state"""
         url = '/v1/apps'
@@ -272,6 +312,171 @@ class ContainerTest(TransactionTestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['release'], 'v4')
 
+    def test_container_bulk_insert(self):
+        """Scaling and deploying insert all new containers with a single query."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 20, 'worker': 10}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        inserts = [q for q in queries if 'INSERT INTO "api_container"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+        app = App.objects.get(id=app_id)
+        self.assertEqual(app.container_set.filter(type='web').count(), 20)
+        self.assertEqual(sorted(c.num for c in app.container_set.filter(type='worker')),
+                         range(1, 11))
+        # a new release clones every container at once
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'KEY': 'value'})}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        inserts = [q for q in queries if 'INSERT INTO "api_container"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(app.container_set.count(), 30)
+        self.assertEqual(set(c.release.version for c in app.container_set.all()), {3})
+
+    def test_container_bind(self):
+        """Containers share their app and releases, loaded once for all of them."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 10, 'worker': 5}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        app = App.objects.get(id=app_id)
+        containers = list(app.container_set.all())
+        with self.assertNumQueries(1):
+            app._bind(containers)
+        with self.assertNumQueries(0):
+            for c in containers:
+                c._create_options()
+                c._run_args('ls')
+        self.assertEqual(len(set(id(c.release) for c in containers)), 1)
+        # a release that is already loaded is used as it is
+        release = app._latest_release()
+        with self.assertNumQueries(0):
+            app._bind(list(containers), release)
+
+    def test_container_scale_coalesced(self):
+        """Scales waiting for the app's lock are merged and applied at once."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=app_id)
+        results, scales = {}, []
+        scale_once = App._scale
+
+        def _scale(self, user, structure):
+            scales.append(dict(structure))
+            return scale_once(self, user, structure)
+
+        def scale(i, structure):
+            results[i] = App.objects.get(pk=app.pk).scale(self.user, structure)
+
+        def pending():
+            return models._pending_scales.get(app.pk, {}).get('structure', {})
+
+        threads = []
+        structures = ({'web': 3}, {'web': 5, 'worker': 1}, {'worker': 2})
+        with mock.patch.object(App, '_scale', _scale):
+            # hold the lock as an operation in flight would
+            with app_lock(app):
+                for i, structure in enumerate(structures):
+                    threads.append(threading.Thread(target=scale, args=(i, structure)))
+                    threads[-1].start()
+                    # wait for the request to be registered
+                    while not set(structure.items()) <= set(pending().items()):
+                        time.sleep(0.01)
+            for t in threads:
+                t.join()
+        # later counts win, and counts of other types are kept
+        self.assertEqual(scales, [{'web': 5, 'worker': 2}])
+        self.assertEqual(results, {0: True, 1: True, 2: True})
+        # nothing is left behind once nobody waits for the app
+        self.assertNotIn(app.pk, models._app_locks)
+        self.assertNotIn(app.pk, models._pending_scales)
+        self.assertEqual(App.objects.get(pk=app.pk).structure, {'web': 5, 'worker': 2})
+        self.assertEqual(app.container_set.filter(type='web').count(), 5)
+        self.assertEqual(app.container_set.filter(type='worker').count(), 2)
+
+    def test_container_partial_deploy(self):
+        """Only process types whose unit changed are replaced by a deploy."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 2, 'worker': 3}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        app = App.objects.get(id=app_id)
+        web = set(app.container_set.filter(type='web').values_list('uuid', flat=True))
+        # changing the worker limits leaves the web containers running
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        body = {'memory': json.dumps({'worker': '512M'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            set(app.container_set.filter(type='web').values_list('uuid', flat=True)), web)
+        versions = dict((c.type, set()) for c in app.container_set.all())
+        for c in app.container_set.all():
+            versions[c.type].add(c.release.version)
+        self.assertEqual(versions, {'web': {2}, 'worker': {3}})
+        self.assertEqual(set(c.state for c in app.container_set.all()), {'up'})
+        # a later deploy compares each container with the release it runs
+        body = {'cpu': json.dumps({'worker': 512})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            set(app.container_set.filter(type='web').values_list('uuid', flat=True)), web)
+        self.assertEqual(set(c.release.version for c in app.container_set.filter(type='worker')),
+                         {4})
+        # new values change the image of every process type
+        body = {'values': json.dumps({'KEY': 'value'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(set(c.release.version for c in app.container_set.all()), {5})
+        self.assertEqual(app.container_set.count(), 5)
+
     def test_container_errors(self):
         url = '/v1/apps'
         response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
@@ -0,0 +1,80 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import mock
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from api.executor import Executor
+
+
+class ExecutorTest(SimpleTestCase):
+    """Tests the bounded executor used to fan out scheduler calls"""
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = self.peak = 0
+
+    def _work(self, item):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        if item == 'boom':
+            raise RuntimeError(item)
+        return item * 2
+
+    def test_results_and_errors(self):
+        executor = Executor(4)
+        tasks = executor.map('app', self._work, [1, 'boom', 3])
+        self.assertEqual(tasks[0].wait(), 2)
+        self.assertRaises(RuntimeError, tasks[1].wait)
+        self.assertEqual(tasks[2].wait(), 6)
+
+    def test_global_limit(self):
+        executor = Executor(5)
+        threads = [threading.Thread(target=executor.map, args=(key, self._work, range(20)))
+                   for key in ('a', 'b', 'c')]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(self.peak, 5)
+        self.assertLessEqual(executor._workers, 5)
+
+    def test_per_key_limit(self):
+        executor = Executor(10, max_per_key=3)
+        executor.map('app', self._work, range(30))
+        self.assertEqual(self.peak, 3)
+        self.assertEqual(executor._running, {})
+
+    def _wait_for_workers(self):
+        for _ in range(500):
+            if not [t for t in threading.enumerate() if t.name == 'executor']:
+                return
+            time.sleep(0.01)
+
+    def test_workers_exit(self):
+        executor = Executor(4)
+        workers, closed = set(), set()
+
+        def work(item):
+            workers.add(threading.current_thread().ident)
+            time.sleep(0.01)
+
+        with mock.patch('api.executor.connection') as connection:
+            connection.close.side_effect = lambda: closed.add(threading.current_thread().ident)
+            executor.map('app', work, range(8))
+            self._wait_for_workers()
+        # workers take more tasks while there are any, and close their database
+        # connection as they exit
+        self.assertEqual(executor._workers, 0)
+        self.assertLess(len(workers), 8)
+        self.assertTrue(workers <= closed)
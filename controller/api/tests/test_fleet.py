@@ -0,0 +1,419 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import copy
+import json
+import mock
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from scheduler import asyncfleet, fleet
+
+
+class Clock(object):
+    """Stands in for :func:`time.time`, advancing only when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _legacy_unit(name, image, command, template, **kwargs):
+    """Render a unit the way the fleet client did before templates were compiled"""
+    unit = copy.deepcopy(template)
+    l = {'name': name, 'image': image, 'command': command}
+    l.update(fleet.MATCH.match(name).groupdict())
+    mem = kwargs.get('memory', {}).get(l['c_type'], None)
+    l['memory'] = '-m {}'.format(mem.lower()) if mem else ''
+    cpu = kwargs.get('cpu', {}).get(l['c_type'], None)
+    l['cpu'] = '-c {}'.format(cpu) if cpu else ''
+    if kwargs.get('entrypoint'):
+        l['entrypoint'] = kwargs['entrypoint']
+    for f in unit:
+        f['value'] = f['value'].format(**l)
+    tags = kwargs.get('tags', {})
+    if tags:
+        tagset = ' '.join(['"{}={}"'.format(k, v) for k, v in tags.items()])
+        unit.append({"section": "X-Fleet", "name": "MachineMetadata", "value": tagset})
+    return unit
+
+
+class FakeFleet(object):
+    """Serves HTTP over a Unix domain socket, answering each request with `handler`
+
+    `handler(method, url, body)` returns a ``(status, data)`` tuple, or None to
+    leave the request unanswered. Connections are kept alive unless the client
+    asks otherwise or `drop` is set, in which case they are closed after every
+    response without telling the client.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.drop = False
+        self.requests = []
+        self.connections = 0
+        self._dir = tempfile.mkdtemp()
+        self.path = os.path.join(self._dir, 'fleet.sock')
+        self._stop = threading.Event()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(128)
+        self._sock.settimeout(0.05)
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            self.connections += 1
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn):
+        conn.settimeout(None)
+        f = conn.makefile('rb')
+        try:
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                method, url, _ = line.split(' ', 2)
+                headers = {}
+                for line in iter(f.readline, '\r\n'):
+                    key, value = line.split(':', 1)
+                    headers[key.lower()] = value.strip()
+                body = f.read(int(headers.get('content-length', 0)))
+                self.requests.append((method, url, body, time.time()))
+                result = self.handler(method, url, body)
+                if result is None:
+                    self._stop.wait()
+                    return
+                status, data = result
+                keep = headers.get('connection') != 'close'
+                conn.sendall('HTTP/1.1 {} Fake\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n{}'.format(
+                                 status, len(data), 'keep-alive' if keep else 'close', data))
+                if not keep or self.drop:
+                    return
+        finally:
+            f.close()
+            conn.close()
+
+    def count(self, method, url=''):
+        return len([r for r in self.requests if r[0] == method and url in r[1]])
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._sock.close()
+        shutil.rmtree(self._dir)
+
+
+class FleetTest(SimpleTestCase):
+    """Tests the plumbing of the fleet scheduler client"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(fleet._shared, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_options(self):
+        """Clients share connections and polling until their options change."""
+        client = fleet.FleetHTTPClient('/tmp/fleet.sock', None, {}, None)
+        same = fleet.FleetHTTPClient('/tmp/fleet.sock', None, {}, None)
+        for attr in ('pool', 'poller', 'machines', 'ssh'):
+            self.assertIs(getattr(same, attr), getattr(client, attr))
+        other = fleet.FleetHTTPClient('/tmp/other.sock', None, {}, None)
+        self.assertIsNot(other.pool, client.pool)
+        # new options rebuild what depends on them, closing what they replace
+        with mock.patch.object(fleet.UHTTPConnectionPool, 'close') as close:
+            changed = fleet.FleetHTTPClient('/tmp/fleet.sock', None,
+                                            {'pool_size': '5', 'wait_first': '1'}, None)
+        close.assert_called_once_with()
+        self.assertEqual(changed.pool.size, 5)
+        self.assertEqual(changed.poller.policy.first, 1)
+        for attr in ('pool', 'poller', 'machines'):
+            self.assertIsNot(getattr(changed, attr), getattr(client, attr))
+        self.assertIs(changed.ssh, client.ssh)
+        changed = fleet.FleetHTTPClient('/tmp/fleet.sock', None, {'pool_size': '5'}, None)
+        self.assertEqual(changed.poller.policy.first, fleet.WAIT_FIRST)
+        self.assertIs(fleet.FleetHTTPClient('/tmp/fleet.sock', None, {'pool_size': '5'},
+                                            None).poller, changed.poller)
+        changed = fleet.FleetHTTPClient('/tmp/fleet.sock', None,
+                                        {'pool_size': '5', 'machine_ttl': '1',
+                                         'ssh_idle_timeout': '10'}, None)
+        self.assertEqual(changed.machines.ttl, 1)
+        self.assertEqual(changed.ssh.idle_timeout, 10)
+        # a fixed poll interval only replaces the backoff of the state poller
+        fixed = fleet.FleetHTTPClient('/tmp/fleet.sock', None,
+                                      {'pool_size': '5', 'poll_interval': '2'}, None)
+        self.assertEqual(fixed.poller.policy,
+                         fleet.WaitPolicy(first=2, factor=1, ceiling=2, jitter=0))
+        self.assertEqual(fixed.policy, fleet.WaitPolicy())
+
+    def test_pool_keepalive(self):
+        server = FakeFleet(lambda method, url, body: (200, '{}'))
+        self.addCleanup(server.close)
+        pool = fleet.UHTTPConnectionPool(server.path, size=2)
+        for _ in range(3):
+            resp, data = pool.request('GET', '/v1-alpha/units')
+            self.assertEqual((resp.status, data), (200, '{}'))
+        self.assertEqual(server.connections, 1)
+        # connections idle for too long are replaced
+        pool.idle_timeout = 0
+        pool.request('GET', '/v1-alpha/units')
+        self.assertEqual(server.connections, 2)
+
+    def test_pool_reconnect(self):
+        """A keep-alive connection that fleet closed is replaced transparently."""
+        server = FakeFleet(lambda method, url, body: (200, '{}'))
+        self.addCleanup(server.close)
+        server.drop = True
+        pool = fleet.UHTTPConnectionPool(server.path)
+        for i in range(3):
+            resp, data = pool.request('PUT', '/v1-alpha/units/a.service', body='{}')
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(server.connections, i + 1)
+        self.assertEqual(server.count('PUT'), 3)
+        # a broken pipe on a connection in use is retried once on a new one
+        conn, _ = pool._idle[-1]
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(pool.request('GET', '/v1-alpha/units')[0].status, 200)
+        # a fresh connection that fails is not retried
+        server.close()
+        pool.close()
+        self.assertRaises(socket.error, pool.request, 'GET', '/v1-alpha/units')
+
+    def test_poller_single_fetch(self):
+        """Many containers waiting together cost one fleet request per poll."""
+        fetches = []
+
+        def fetch():
+            fetches.append(time.time())
+            return {'app_v2.web.{}'.format(i): {'systemdSubState': 'running'}
+                    for i in range(20)}
+        poller = fleet.UnitStatePoller(None, fleet.WaitPolicy(first=0.3, jitter=0))
+        poller._fetch = fetch
+        self.assertEqual(next(poller.watch('app_v2.web.0', 5)), {'systemdSubState': 'running'})
+        self.assertEqual(len(fetches), 1)
+        seen = {}
+
+        def wait(name):
+            seen[name] = next(poller.watch(name, 5))
+        threads = [threading.Thread(target=wait, args=('app_v2.web.{}'.format(i),))
+                   for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(fetches), 2)
+        self.assertEqual(len(seen), 20)
+        self.assertEqual(set(s['systemdSubState'] for s in seen.values()), set(['running']))
+        # the unit is None once it is gone from fleet
+        self.assertIsNone(next(poller.watch('app_v2.web.21', 5)))
+        self.assertEqual(len(fetches), 3)
+
+    def test_wait_policy(self):
+        clock = Clock()
+        policy = fleet.WaitPolicy(first=1, factor=2, ceiling=5, jitter=0)
+        delays = []
+        with mock.patch.object(fleet.time, 'time', clock):
+            for delay in policy.delays(20):
+                delays.append(delay)
+                clock.sleep(delay)
+        # delays grow to the ceiling, and the last one ends at the deadline
+        self.assertEqual(delays, [1, 2, 4, 5, 5, 3])
+        policy = fleet.WaitPolicy.from_options({'wait_jitter': '0.5'})
+        for _ in range(100):
+            self.assertTrue(0.5 <= policy.jittered(1) <= 1.5)
+
+    def test_phase_deadline(self):
+        """Each wait phase gives up once its own deadline has passed."""
+        client = fleet.FleetHTTPClient('/tmp/fleet.sock', None, {
+            'start_timeout': 0.3, 'destroy_timeout': 0.2, 'wait_first': 0.01}, None)
+        states = {'app_v2.web.1': {'systemdSubState': 'start-pre'}}
+        client.poller._fetch = lambda: states
+        began = time.time()
+        self.assertRaises(RuntimeError, client.start, 'app_v2.web.1')
+        self.assertTrue(0.3 <= time.time() - began < 2)
+        began = time.time()
+        with mock.patch.object(client, '_destroy_container'):
+            self.assertRaises(RuntimeError, client.destroy, 'app_v2.web.1')
+        self.assertTrue(0.2 <= time.time() - began < 2)
+        states['app_v2.web.1']['systemdSubState'] = 'running'
+        client.start('app_v2.web.1')
+
+    def test_compiled_unit(self):
+        """Units built from the template cache match those rendered from scratch."""
+        client = fleet.FleetHTTPClient('/tmp/fleet.sock', None, {}, None)
+        kwargs = [{}, {'memory': {'web': '1G'}, 'cpu': {'web': 512},
+                       'tags': {'env': 'prod', 'dc': 'east'}}]
+        for kw in kwargs:
+            for name in ('autotest_v2.web.1', 'autotest_v2.web.12', 'other-app_v10.web.3'):
+                unit = client._build_unit(name, 'autotest:v2', 'start web',
+                                          fleet.CONTAINER_TEMPLATE, **kw)
+                expected = _legacy_unit(name, 'autotest:v2', 'start web',
+                                        fleet.CONTAINER_TEMPLATE, **kw)
+                self.assertEqual(json.dumps(unit), json.dumps(expected))
+        name = 'autotest_v2.run.1'
+        unit = client._build_unit(name, 'autotest:v2', 'ls -l', fleet.RUN_TEMPLATE,
+                                  entrypoint='/bin/sh')
+        expected = _legacy_unit(name, 'autotest:v2', 'ls -l', fleet.RUN_TEMPLATE,
+                                entrypoint='/bin/sh')
+        self.assertEqual(json.dumps(unit), json.dumps(expected))
+
+    def test_ssh_pool(self):
+        pool = fleet.SSHTransportPool()
+        clients = []
+
+        def connect(host, username, pkey):
+            clients.append(mock.Mock())
+            return clients[-1]
+        pool._connect = connect
+        with pool.transport('10.0.0.1', None) as tran:
+            pass
+        with pool.transport('10.0.0.1', None) as again:
+            self.assertIs(again, tran)
+        self.assertEqual(len(clients), 1)
+        with pool.transport('10.0.0.2', None):
+            self.assertEqual(len(clients), 2)
+        # a transport that died is replaced on checkout
+        tran.is_active.return_value = False
+        with pool.transport('10.0.0.1', None) as tran:
+            self.assertIs(tran, clients[2].get_transport())
+        self.assertTrue(clients[0].close.called)
+        # only transports idle for long enough are evicted
+        with pool.transport('10.0.0.2', None):
+            self.assertEqual(pool.evict(idle_timeout=0), 1)
+            self.assertTrue(clients[2].close.called)
+            self.assertFalse(clients[1].close.called)
+        self.assertEqual(pool.evict(idle_timeout=60), 1)
+        pool.close()
+        self.assertTrue(clients[1].close.called)
+        self.assertEqual(pool.evict(), 0)
+
+    def test_machine_cache(self):
+        clock = Clock()
+        inventory = {'a': {'id': 'a', 'metadata': {'dc': 'east'}}}
+        cache = fleet.MachineCache(None, ttl=30)
+        cache._fetch = mock.Mock(side_effect=lambda: dict(inventory))
+        with mock.patch.object(fleet.time, 'time', clock):
+            self.assertEqual(cache.get('a')['id'], 'a')
+            clock.sleep(10)
+            cache.get('a')
+            self.assertEqual(cache.metadata(), {'dc': set(['east'])})
+            self.assertEqual(cache._fetch.call_count, 1)
+            # a machine that just joined is found by refreshing on a miss
+            inventory['b'] = {'id': 'b'}
+            self.assertEqual(cache.get('b')['id'], 'b')
+            self.assertEqual(cache._fetch.call_count, 2)
+            self.assertIsNone(cache.get('c'))
+            self.assertEqual(cache._fetch.call_count, 3)
+            # the inventory expires after its ttl
+            clock.sleep(29)
+            cache.machines()
+            self.assertEqual(cache._fetch.call_count, 3)
+            clock.sleep(1)
+            self.assertEqual(len(cache.machines()), 2)
+            self.assertEqual(cache._fetch.call_count, 4)
+
+
+class AsyncFleetTest(SimpleTestCase):
+    """Tests the event loop of the asyncfleet scheduler client against a fake fleet"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(fleet._shared, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.answers = {}
+        self.units = {}
+        self.fleet = FakeFleet(self.handle)
+        self.addCleanup(self.fleet.close)
+
+    def handle(self, method, url, body):
+        name = url.split('/')[-1].rsplit('.service', 1)[0]
+        answers = self.answers.get((method, name))
+        if answers:
+            answer = answers.pop(0)
+            if answer is not None:
+                return answer, ''
+            return None
+        if method == 'PUT':
+            self.units[name] = json.loads(body)
+            return 201, ''
+        if method == 'DELETE':
+            return (204, '') if self.units.pop(name, None) else (404, '')
+        states = [{'name': n + '.service', 'systemdSubState': 'running'} for n in self.units]
+        return 200, json.dumps({'states': states})
+
+    def fleet_client(self, **options):
+        options.setdefault('wait_first', 0.01)
+        options.setdefault('wait_jitter', 0)
+        return asyncfleet.AsyncFleetClient(self.fleet.path, None, options, None)
+
+    def test_create_many(self):
+        client = self.fleet_client()
+        names = ['autotest_v2.web.{}'.format(i) for i in range(1, 6)]
+        containers = [{'name': n, 'image': 'autotest:v2'} for n in names]
+        # a name given twice is only created once, and does not hang the loop
+        containers.append(containers[0].copy())
+        errors = client.create_many(containers)
+        self.assertEqual(errors, dict.fromkeys(names))
+        self.assertEqual(sorted(self.units), names)
+        self.assertEqual(self.fleet.count('PUT'), 5)
+        self.assertEqual(client.start_many(names), dict.fromkeys(names))
+        self.assertEqual(client.destroy_many(names), dict.fromkeys(names))
+        self.assertEqual(self.units, {})
+
+    def test_retry_backoff(self):
+        client = self.fleet_client(wait_first=0.05, wait_factor=2)
+        name = 'autotest_v2.web.1'
+        self.answers[('PUT', name)] = [500, 503]
+        client.create(name, 'autotest:v2')
+        self.assertIn(name, self.units)
+        times = [r[3] for r in self.fleet.requests]
+        self.assertEqual(len(times), 3)
+        self.assertGreaterEqual(times[1] - times[0], 0.05)
+        self.assertGreaterEqual(times[2] - times[1], 0.1)
+        # failures are reported once retries run out
+        self.answers[('PUT', name)] = [500] * fleet.RETRIES
+        self.assertRaises(RuntimeError, client.create, name, 'autotest:v2')
+
+    def test_request_timeout(self):
+        """A request fleet never answers fails instead of blocking the loop."""
+        client = self.fleet_client(request_timeout=0.2)
+        self.answers[('PUT', 'autotest_v2.web.1')] = [None] * fleet.RETRIES
+        began = time.time()
+        errors = client.create_many([{'name': 'autotest_v2.web.1', 'image': 'autotest:v2'},
+                                     {'name': 'autotest_v2.web.2', 'image': 'autotest:v2'}])
+        self.assertLess(time.time() - began, 5)
+        self.assertIn('no response from fleet', str(errors['autotest_v2.web.1']))
+        self.assertIsNone(errors['autotest_v2.web.2'])
+        self.assertEqual(self.fleet.count('PUT', 'web.1'), fleet.RETRIES)
+        # a timed out retry that succeeds
+        self.answers[('PUT', 'autotest_v2.web.3')] = [None]
+        client.create('autotest_v2.web.3', 'autotest:v2')
+        self.assertIn('autotest_v2.web.3', self.units)
@@ -0,0 +1,225 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import json
+import mock
+import requests
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from api.management.commands import jobworker
+from api.models import App, Job, Release
+
+from scheduler import chaos
+
+
+def mock_import_repository_task(*args, **kwargs):
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content_consumed = True
+    return resp
+
+
+@override_settings(ASYNC_JOBS=True)
+class JobTest(TransactionTestCase):
+
+    """Tests scales and deploys queued for the job worker"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.token = Token.objects.get(user=self.user).key
+
+    def tearDown(self):
+        # reset for subsequent tests
+        settings.SCHEDULER_MODULE = 'mock'
+        chaos.CREATE_ERROR_RATE = 0
+
+    def _run_jobs(self):
+        job = Job.claim()
+        while job is not None:
+            job.run()
+            job = Job.claim()
+
+    @mock.patch('requests.post', mock_import_repository_task)
+    def test_job(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        # a new build is released right away and deployed later
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['X-Deis-Release'], '2')
+        job_id = response['X-Deis-Job']
+        url = "/v1/apps/{app_id}/jobs/{job_id}".format(**locals())
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['action'], 'deploy')
+        self.assertEqual(response.data['state'], 'queued')
+        self.assertEqual(response.data['release'], 'v2')
+        # the worker runs the deploy, including the initial scale
+        self._run_jobs()
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.data['state'], 'succeeded')
+        self.assertIsNotNone(response.data['finished'])
+        self.assertEqual(response.data['progress'], {'up': 1})
+        # scaling is accepted and queued
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 4, 'worker': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['action'], 'scale')
+        self.assertEqual(response.data['params'], {'structure': body})
+        job_id = response.data['uuid']
+        app = App.objects.get(id=app_id)
+        self.assertEqual(app.container_set.count(), 1)
+        self._run_jobs()
+        self.assertEqual(app.container_set.count(), 6)
+        url = "/v1/apps/{app_id}/jobs/{job_id}".format(**locals())
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.data['state'], 'succeeded')
+        self.assertEqual(response.data['progress'], {'up': 6})
+        # invalid structures are still rejected within the request
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'nope': 1}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 400)
+        # config changes and rollbacks are deployed by jobs too
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('X-Deis-Job', response)
+        url = "/v1/apps/{app_id}/releases/rollback/".format(**locals())
+        response = self.client.post(url, json.dumps({'version': 2}),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['version'], 4)
+        self._run_jobs()
+        self.assertEqual(set(c.release.version for c in app.container_set.all()), {4})
+        url = "/v1/apps/{app_id}/jobs".format(**locals())
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(set(j['state'] for j in response.data['results']), {'succeeded'})
+
+    def test_job_claim(self):
+        """Only one job of an app runs at a time, oldest first."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app1 = App.objects.get(id=response.data['id'])
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app2 = App.objects.get(id=response.data['id'])
+        first = Job.objects.create(owner=self.user, app=app1, action='scale')
+        Job.objects.create(owner=self.user, app=app1, action='scale')
+        third = Job.objects.create(owner=self.user, app=app2, action='scale')
+        self.assertEqual(Job.claim(), first)
+        self.assertEqual(Job.claim(), third)
+        self.assertIsNone(Job.claim())
+        self.assertEqual(Job.objects.filter(state='running').count(), 2)
+
+    @mock.patch('requests.post', mock_import_repository_task)
+    def test_job_failure(self):
+        """A failed deploy is recorded on its job and removes its release."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        self._run_jobs()
+        # make every container fail to create
+        settings.SCHEDULER_MODULE = 'chaos'
+        chaos.CREATE_ERROR_RATE = 1
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        job_id = response['X-Deis-Job']
+        self.assertTrue(Release.objects.filter(app__id=app_id, version=3).exists())
+        self._run_jobs()
+        url = "/v1/apps/{app_id}/jobs/{job_id}".format(**locals())
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], 'failed')
+        self.assertIn('aborting', response.data['error'])
+        self.assertIsNone(response.data['release'])
+        self.assertFalse(Release.objects.filter(app__id=app_id, version=3).exists())
+
+    @mock.patch('requests.post', mock_import_repository_task)
+    def test_job_superseded(self):
+        """Consecutive queued scale jobs are merged into the last one."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 202)
+        self._run_jobs()
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        jobs = []
+        for body in ({'web': 4}, {'worker': 3}, {'web': 2}):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 202)
+            jobs.append(response.data['uuid'])
+        self._run_jobs()
+        jobs = [Job.objects.get(pk=j) for j in jobs]
+        self.assertEqual([j.state for j in jobs], ['superseded', 'superseded', 'succeeded'])
+        # each superseded job names the job that did its work
+        self.assertEqual([j.params.get('superseded_by') for j in jobs],
+                         [jobs[1].uuid, jobs[2].uuid, None])
+        self.assertEqual(jobs[2].params['structure'], {'web': 2, 'worker': 3})
+        app = App.objects.get(id=app_id)
+        self.assertEqual(app.structure, {'web': 2, 'worker': 3})
+        self.assertEqual(app.container_set.filter(type='web').count(), 2)
+        self.assertEqual(app.container_set.filter(type='worker').count(), 3)
+
+    def test_worker_errors(self):
+        """A worker outlives errors claiming or running jobs."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        job = Job.objects.create(owner=self.user, app=app, action='scale')
+        with mock.patch.object(Job, 'claim', side_effect=RuntimeError('database is gone')):
+            self.assertFalse(jobworker._work_once())
+        self.assertEqual(Job.objects.get(pk=job.pk).state, 'queued')
+        # a job that fails outside of its own error handling is still marked failed
+        with mock.patch.object(Job, 'run', side_effect=RuntimeError('database is gone')):
+            self.assertTrue(jobworker._work_once())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.error, 'database is gone')
+        self.assertIsNotNone(job.finished)
+        self.assertFalse(jobworker._work_once())
@@ -0,0 +1,107 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import json
+import mock
+import requests
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api.models import App, Container
+from api.reconciler import reconcile
+
+
+def mock_import_repository_task(*args, **kwargs):
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content_consumed = True
+    return resp
+
+
+class ReconcilerTest(TransactionTestCase):
+
+    """Tests that container states follow what the scheduler reports"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.token = Token.objects.get(user=self.user).key
+
+    @mock.patch('requests.post', mock_import_repository_task)
+    def test_reconcile(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 4, 'worker': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        app = App.objects.get(id=app_id)
+        names = dict((c._job_id, c.pk) for c in app.container_set.all())
+        states = dict.fromkeys(names, 'up')
+        # web.1 crashed, web.2 is restarting, web.3 vanished and worker.1 came back
+        states['{}_v2.web.1'.format(app_id)] = 'crashed'
+        states['{}_v2.web.2'.format(app_id)] = None
+        del states['{}_v2.web.3'.format(app_id)]
+        Container.objects.filter(pk=names['{}_v2.worker.1'.format(app_id)]).update(
+            state='crashed')
+        scheduler = mock.Mock()
+        scheduler.states.return_value = states
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reconcile(scheduler), 3)
+        self.assertEqual(scheduler.states.call_count, 1)
+        updates = [q for q in queries if 'UPDATE' in q['sql']]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(
+            dict((c._job_id, c.state) for c in app.container_set.all()),
+            {'{}_v2.web.1'.format(app_id): 'crashed',
+             '{}_v2.web.2'.format(app_id): 'up',
+             '{}_v2.web.3'.format(app_id): 'crashed',
+             '{}_v2.web.4'.format(app_id): 'up',
+             '{}_v2.worker.1'.format(app_id): 'up',
+             '{}_v2.worker.2'.format(app_id): 'up'})
+        # nothing left to correct
+        self.assertEqual(reconcile(scheduler), 0)
+        # containers in the middle of an operation are left alone
+        Container.objects.filter(pk=names['{}_v2.web.4'.format(app_id)]).update(
+            state='created')
+        states['{}_v2.web.4'.format(app_id)] = 'crashed'
+        self.assertEqual(reconcile(scheduler), 0)
+        # a container that came up after the snapshot was taken is not in it
+        web4 = Container.objects.filter(pk=names['{}_v2.web.4'.format(app_id)])
+        del states['{}_v2.web.4'.format(app_id)]
+
+        def snapshot():
+            web4.update(state='up', updated=timezone.now())
+            return states
+        scheduler.states.side_effect = snapshot
+        self.assertEqual(reconcile(scheduler), 0)
+        self.assertEqual(web4.get().state, 'up')
+        # and is corrected by the next run
+        scheduler.states.side_effect = None
+        self.assertEqual(reconcile(scheduler), 1)
+        self.assertEqual(web4.get().state, 'crashed')
+
+    def test_reconcile_unsupported(self):
+        """Schedulers without unit states, like the mock one, are skipped."""
+        self.assertEqual(reconcile(), 0)
+        self.assertEqual(reconcile(mock.Mock(spec=['create', 'destroy'])), 0)
@@ -0,0 +1,222 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import json
+import cStringIO
+import mock
+import requests
+import tarfile
+import threading
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from registry import private
+
+
+def _response(status_code, data={}):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(data).encode('utf-8')
+    return resp
+
+
+class FakeRegistry(object):
+    """Answers registry API calls from memory, recording each of them"""
+
+    def __init__(self):
+        self.images = {'base': {'id': 'base', 'parent': '', 'config': {'Env': ['PATH=/bin']}}}
+        self.tags = {('autotest/example', 'git-abc'): 'base'}
+        self.layers = {}
+        self.calls = []
+
+    def __call__(self, endpoint, data=None, headers={}, cookies=None, request_type='GET'):
+        path = endpoint.split('/v1/', 1)[1]
+        self.calls.append((request_type, path))
+        parts = path.split('/')
+        if parts[0] == 'repositories':
+            key = ('/'.join(parts[1:-2]), parts[-1])
+            if request_type == 'PUT':
+                self.tags[key] = json.loads(data)
+                return _response(200, 'OK')
+            if key not in self.tags:
+                return _response(404)
+            return _response(200, self.tags[key])
+        if parts[2] == 'layer':
+            # streamed layers are sent as they are read
+            self.layers[parts[1]] = b''.join(data)
+            return _response(200)
+        if parts[2] == 'json':
+            if request_type == 'PUT':
+                self.images[parts[1]] = json.loads(data)
+                return _response(200)
+            return _response(200, self.images[parts[1]])
+        return _response(200)
+
+    def count(self, request_type, kind):
+        return len([c for c in self.calls if c[0] == request_type and kind in c[1]])
+
+
+@override_settings(REGISTRY_RETRY_BACKOFF=0)
+class RegistryTest(SimpleTestCase):
+    """Tests calls to the private registry"""
+
+    def test_session(self):
+        """Threads keep their own session on top of one pool of connections."""
+        session = private._session()
+        self.assertIs(private._session(), session)
+        other = []
+        t = threading.Thread(target=lambda: other.append(private._session()))
+        t.start()
+        t.join()
+        self.assertIsNot(other[0], session)
+        self.assertIs(other[0].get_adapter('http://registry'),
+                      session.get_adapter('http://registry'))
+
+    @override_settings(REGISTRY_RETRIES=2)
+    def test_retries(self):
+        with mock.patch('requests.Session.request') as request:
+            request.side_effect = [requests.ConnectionError('refused'), _response(503),
+                                   _response(200)]
+            r = private._api_call('http://registry/v1/images/abc/json')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(request.call_count, 3)
+            self.assertEqual(request.call_args[0], ('GET', 'http://registry/v1/images/abc/json'))
+            self.assertIn('timeout', request.call_args[1])
+        # the last answer is returned once retries run out
+        with mock.patch('requests.Session.request') as request:
+            request.return_value = _response(502)
+            r = private._api_call('http://registry/v1/images/abc/json', data='{}',
+                                  request_type='PUT')
+            self.assertEqual(r.status_code, 502)
+            self.assertEqual(request.call_count, 3)
+        with mock.patch('requests.Session.request') as request:
+            request.side_effect = requests.Timeout('slow')
+            self.assertRaises(requests.Timeout, private._api_call, 'http://registry/')
+            self.assertEqual(request.call_count, 3)
+        # client errors are final
+        with mock.patch('requests.Session.request') as request:
+            request.return_value = _response(404)
+            self.assertEqual(private._api_call('http://registry/').status_code, 404)
+            self.assertEqual(request.call_count, 1)
+
+    def test_metadata_cache(self):
+        cache = private.MetadataCache(2)
+        cache.set('a', {'x': 1})
+        cache.get('a')['x'] = 2
+        self.assertEqual(cache.get('a'), {'x': 1})
+        cache.set('b', 'b')
+        cache.get('a')
+        cache.set('c', 'c')
+        # the least recently used entry is dropped
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'x': 1})
+        self.assertEqual(cache.get('c'), 'c')
+
+    def test_metadata_cache_ttl(self):
+        cache = private.MetadataCache(10, 'redis://localhost:6379/0', ttl=60)
+        cache._redis = redis = mock.Mock()
+        redis.get.return_value = None
+        with mock.patch.object(private.time, 'time') as now:
+            now.return_value = 1000
+            cache.set('tag:app:v2', 'abc')
+            redis.set.assert_called_once_with('deis:registry:tag:app:v2', '"abc"', ex=60)
+            now.return_value = 1059
+            self.assertEqual(cache.get('tag:app:v2'), 'abc')
+            now.return_value = 1060
+            self.assertIsNone(cache.get('tag:app:v2'))
+
+    def test_metadata_cache_redis(self):
+        shared = {}
+        cache = private.MetadataCache(10, 'redis://localhost:6379/0')
+        redis = mock.Mock()
+        redis.get.side_effect = shared.get
+        redis.set.side_effect = lambda key, data, ex: shared.__setitem__(key, data)
+        cache._redis = redis
+        cache.set('image:abc', {'id': 'abc'})
+        # another process finds what this one cached
+        other = private.MetadataCache(10, 'redis://localhost:6379/0')
+        other._redis = redis
+        self.assertEqual(other.get('image:abc'), {'id': 'abc'})
+        self.assertIsNone(other.get('image:def'))
+        # an unreachable server leaves the local cache working
+        redis.get.side_effect = redis.set.side_effect = Exception('connection refused')
+        other.set('tag:app:v2', 'abc')
+        self.assertEqual(other.get('tag:app:v2'), 'abc')
+        self.assertIsNone(other.get('image:def'))
+
+    def test_publish_cached(self):
+        """Publishing from the same build again does not fetch its image again."""
+        registry = FakeRegistry()
+        with mock.patch.object(private, '_cache', private.MetadataCache(10)), \
+                mock.patch.object(private, '_api_call', registry):
+            private.publish_release('autotest/example:git-abc', {'A': '1'}, 'autotest:v2')
+            self.assertEqual(registry.count('GET', 'tags/git-abc'), 1)
+            self.assertEqual(registry.count('GET', 'images/base/json'), 1)
+            private.publish_release('autotest/example:git-abc', {'A': '2'}, 'autotest:v3')
+            self.assertEqual(registry.count('GET', 'tags/git-abc'), 2)
+            self.assertEqual(registry.count('GET', 'images/base/json'), 1)
+            env = registry.images[registry.tags[('autotest', 'v3')]]['config']['Env']
+            self.assertIn('A=2', env)
+            self.assertNotIn('A=1', env)
+            # our own release tags are cached, and tags that move are always looked up
+            self.assertEqual(private._get_tag('autotest', 'v3'), registry.tags[('autotest', 'v3')])
+            self.assertEqual(registry.count('GET', 'tags/'), 2)
+            registry.tags[('autotest/example', 'latest')] = 'base'
+            private._get_tag('autotest/example', 'latest')
+            private._get_tag('autotest/example', 'latest')
+            self.assertEqual(registry.count('GET', 'tags/'), 4)
+            # a build pushed again moves its tag
+            registry.images['rebuilt'] = {'id': 'rebuilt', 'parent': '', 'config': {'Env': []}}
+            registry.tags[('autotest/example', 'git-abc')] = 'rebuilt'
+            private.publish_release('autotest/example:git-abc', {'A': '3'}, 'autotest:v4')
+            self.assertEqual(registry.count('GET', 'tags/git-abc'), 3)
+            v4 = registry.images[registry.tags[('autotest', 'v4')]]
+            self.assertEqual(v4['parent'], 'rebuilt')
+
+    def test_empty_layer(self):
+        layer = private._empty_tar_archive()
+        self.assertEqual(tarfile.open(fileobj=layer).getmembers(), [])
+        # each caller reads from the start of its own copy
+        self.assertEqual(private._empty_tar_archive().read(), private._EMPTY_TAR)
+
+    def test_stream_layer(self):
+        """Layers are uploaded in chunks and hashed in the same pass."""
+        data = cStringIO.StringIO()
+        tar = tarfile.open(mode='w', fileobj=data)
+        for name, size in (('app/big', private.CHUNK_SIZE * 3 + 5), ('app/small', 10)):
+            info = tarfile.TarInfo(name)
+            info.size = size
+            tar.addfile(info, cStringIO.StringIO(b'x' * size))
+        info = tarfile.TarInfo('app')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        info = tarfile.TarInfo('app/link')
+        info.type = tarfile.SYMTYPE
+        info.linkname = 'small'
+        tar.addfile(info)
+        tar.close()
+        layer = data.getvalue()
+        expected = private.TarSum('{}')
+        tar = tarfile.open(fileobj=cStringIO.StringIO(layer))
+        for member in tar:
+            expected.append(member, tar)
+        tarsum = private.TarSum('{}')
+        with mock.patch.object(private, '_api_call') as api_call:
+            api_call.return_value = _response(200)
+            private._put_layer('abc', cStringIO.StringIO(layer), tarsum)
+        chunks = list(api_call.call_args[1]['data'])
+        self.assertEqual(b''.join(chunks), layer)
+        self.assertLessEqual(max(len(c) for c in chunks), private.CHUNK_SIZE * 2)
+        self.assertNotIn(b'', chunks)
+        self.assertEqual(tarsum.compute(), expected.compute())
+        # streamed data is not sent twice
+        with mock.patch('requests.Session.request') as request:
+            request.return_value = _response(503)
+            private._api_call('http://registry/', data=iter([b'x']), request_type='PUT')
+            self.assertEqual(request.call_count, 1)
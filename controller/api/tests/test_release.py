@@ -206,6 +206,44 @@ class ReleaseTest(TransactionTestCase):
         self.assertIn('NEW_URL1', values)
         self.assertEqual('http://localhost:8080/', values['NEW_URL1'])
 
+    @mock.patch('requests.post', mock_import_repository_task)
+    def test_release_rollback_publish(self):
+        """A rollback publishes from the image of the release it goes back to."""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/v1/apps/{app_id}/builds'.format(**locals())
+        body = {'image': 'autotest/example'}
+        response = self.client.post(
+            url, json.dumps(body), content_type='application/json',
+            HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = '/v1/apps/{app_id}/config'.format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        response = self.client.post(
+            url, json.dumps(body), content_type='application/json',
+            HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/releases/rollback/".format(**locals())
+        with mock.patch('api.models.publish_release') as publish:
+            response = self.client.post(
+                url, json.dumps({'version': 2}), content_type='application/json',
+                HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 201)
+        publish.assert_called_once_with('{}:v2'.format(app_id), {}, '{}:v4'.format(app_id))
+        # a release whose image is missing is published from its build again
+        with mock.patch('api.models.publish_release') as publish:
+            publish.side_effect = [RuntimeError('GET Image Error (404: not found)'), None]
+            response = self.client.post(
+                url, json.dumps({'version': 3}), content_type='application/json',
+                HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(publish.call_args[0],
+                         ('autotest/example:latest', {'NEW_URL1': 'http://localhost:8080/'},
+                          '{}:v5'.format(app_id)))
+
     @mock.patch('requests.post', mock_import_repository_task)
     def test_release_str(self):
         """Test the text representation of a release."""
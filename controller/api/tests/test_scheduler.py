@@ -7,13 +7,20 @@ Run the tests with "./manage.py test api"
 from __future__ import unicode_literals
 
 import json
+import mock
+import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TransactionTestCase
 from rest_framework.authtoken.models import Token
 
+from api.models import App, Container
+
+import scheduler
 from scheduler import chaos
+from scheduler.metrics import metrics, Metrics, PUBLISH_INTERVAL
 
 
 class SchedulerTest(TransactionTestCase):
@@ -281,6 +288,258 @@ class SchedulerTest(TransactionTestCase):
         states = set([c['state'] for c in response.data['results']])
         self.assertEqual(states, set(['up']))
 
+    def test_config_chaos_pipelined(self):
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        # post a new build
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        # scale up
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 20}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        # simulate failing to create or start containers
+        chaos.CREATE_ERROR_RATE = 0.5
+        chaos.START_ERROR_RATE = 0.5
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        with self.settings(DEPLOY_STRATEGY='pipelined'):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 503)
+        # make sure all old containers are still up
+        containers = Container.objects.filter(app__id=app_id)
+        self.assertEqual(len(containers), 20)
+        self.assertEqual(set([c.state for c in containers]), set(['up']))
+        self.assertEqual(set([c.release.version for c in containers]), set([2]))
+        # without atomic deploys, containers that fail to create keep their release,
+        # and a deploy that replaced none of them is rolled back
+        chaos.CREATE_ERROR_RATE = 1
+        with self.settings(DEPLOY_STRATEGY='pipelined', DEPLOY_ATOMIC=False):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 503)
+        containers = Container.objects.filter(app__id=app_id)
+        self.assertEqual(len(containers), 20)
+        self.assertEqual(set([c.release.version for c in containers]), set([2]))
+        self.assertEqual(App.objects.get(id=app_id).release_set.latest().version, 2)
+        # one that replaced some fails too, but keeps the release they run
+        chaos.CREATE_ERROR_RATE = 0
+        chaos.START_ERROR_RATE = 0
+        create = chaos.ChaosSchedulerClient.create.im_func
+
+        def create_some(self, name, *args, **kwargs):
+            if int(name.rsplit('.', 1)[1]) <= 5:
+                raise RuntimeError('no capacity')
+            return create(self, name, *args, **kwargs)
+        with self.settings(DEPLOY_STRATEGY='pipelined', DEPLOY_ATOMIC=False), \
+                mock.patch.object(chaos.ChaosSchedulerClient, 'create', create_some):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('5 of 20 containers failed to create', response.content)
+        containers = Container.objects.filter(app__id=app_id)
+        self.assertEqual(len(containers), 20)
+        self.assertEqual(sorted(c.release.version for c in containers), [2] * 5 + [3] * 15)
+        self.assertEqual(App.objects.get(id=app_id).release_set.latest().version, 3)
+        # while the others are replaced one by one
+        body = {'values': json.dumps({'NEW_URL2': 'http://localhost:8080/'})}
+        with self.settings(DEPLOY_STRATEGY='pipelined', DEPLOY_ATOMIC=False):
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        containers = Container.objects.filter(app__id=app_id)
+        self.assertEqual(len(containers), 20)
+        self.assertEqual(set([c.state for c in containers]), set(['up']))
+        self.assertEqual(set([c.release.version for c in containers]), set([4]))
+
+    def test_rolling_deploy(self):
+        """Rolling deploys replace containers in batches within the app's limits"""
+        live, peak = set(), [0]
+
+        def create(self, name, image, command, **kwargs):
+            live.add(name)
+            peak[0] = max(peak[0], len(live))
+
+        def destroy(self, name):
+            live.discard(name)
+
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        # patch.multiple reserves the "create" keyword, so patch each method on its own
+        with mock.patch.object(chaos.ChaosSchedulerClient, 'create', create), \
+                mock.patch.object(chaos.ChaosSchedulerClient, 'destroy', destroy):
+            url = "/v1/apps/{app_id}/scale".format(**locals())
+            body = {'web': 10}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 204)
+            live.update(c._job_id for c in Container.objects.filter(app__id=app_id))
+            for rollout, expected_peak in (({'max_surge': 3}, 13),
+                                           ({'max_surge': 0, 'max_unavailable': 2}, 10),
+                                           ({'max_surge': 1, 'max_unavailable': 1}, 11)):
+                url = '/v1/apps/{}/rollout'.format(app_id)
+                response = self.client.patch(url, json.dumps(rollout),
+                                             content_type='application/json',
+                                             HTTP_AUTHORIZATION='token {}'.format(self.token))
+                self.assertEqual(response.status_code, 200)
+                peak[0] = len(live)
+                url = "/v1/apps/{app_id}/config".format(**locals())
+                body = {'values': json.dumps({'ROLLOUT': json.dumps(rollout)})}
+                response = self.client.post(url, json.dumps(body),
+                                            content_type='application/json',
+                                            HTTP_AUTHORIZATION='token {}'.format(self.token))
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(peak[0], expected_peak)
+                containers = Container.objects.filter(app__id=app_id)
+                self.assertEqual(len(containers), 10)
+                self.assertEqual(len(live), 10)
+                self.assertEqual(set([c.state for c in containers]), set(['up']))
+                self.assertEqual(len(set([c.release.version for c in containers])), 1)
+
+    def test_rolling_deploy_failure(self):
+        """Containers retired by a rolling batch that fails to create are brought back"""
+        live = set()
+        # how many containers of the new release can be created
+        capacity = [0]
+
+        lock = threading.Lock()
+
+        def create(self, name, image, command, **kwargs):
+            with lock:
+                if '_v3.' in name:
+                    if capacity[0] == 0:
+                        raise RuntimeError('no capacity')
+                    capacity[0] -= 1
+                live.add(name)
+
+        # containers that cannot be destroyed
+        stuck = set()
+
+        def destroy(self, name):
+            if name in stuck:
+                raise RuntimeError('stuck')
+            live.discard(name)
+
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = '/v1/apps/{}/rollout'.format(app_id)
+        response = self.client.patch(url, json.dumps({'max_surge': 0, 'max_unavailable': 2}),
+                                     content_type='application/json',
+                                     HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        with mock.patch.object(chaos.ChaosSchedulerClient, 'create', create), \
+                mock.patch.object(chaos.ChaosSchedulerClient, 'destroy', destroy):
+            url = "/v1/apps/{app_id}/scale".format(**locals())
+            body = {'web': 6}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 204)
+            live.update(c._job_id for c in Container.objects.filter(app__id=app_id))
+            # the first batch fails: the deploy is rolled back at full capacity
+            url = "/v1/apps/{app_id}/config".format(**locals())
+            body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 503)
+            containers = Container.objects.filter(app__id=app_id)
+            self.assertEqual(len(containers), 6)
+            self.assertEqual(len(live), 6)
+            self.assertEqual(set([c.state for c in containers]), set(['up']))
+            self.assertEqual(set([c.release.version for c in containers]), set([2]))
+            # the first batch cannot retire all its containers: those it did are restored
+            stuck.add(Container.objects.filter(app__id=app_id).order_by('created')[1]._job_id)
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 503)
+            containers = Container.objects.filter(app__id=app_id)
+            self.assertEqual(len(containers), 6)
+            self.assertEqual(len(live), 6)
+            self.assertEqual(sorted(c.state for c in containers), ['error'] + ['up'] * 5)
+            self.assertEqual(set([c.release.version for c in containers]), set([2]))
+            self.assertEqual(App.objects.get(id=app_id).release_set.latest().version, 2)
+            stuck.clear()
+            # a later batch fails: the rollout stops, still at full capacity, and the
+            # deploy fails but keeps the release some containers now run
+            capacity[0] = 2
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('rollout stopped after replacing 2 of 6 containers', response.content)
+            containers = Container.objects.filter(app__id=app_id)
+            self.assertEqual(len(containers), 6)
+            self.assertEqual(len(live), 6)
+            self.assertEqual(set([c.state for c in containers]), set(['up']))
+            self.assertEqual(sorted(c.release.version for c in containers), [2, 2, 2, 2, 3, 3])
+            self.assertEqual(App.objects.get(id=app_id).release_set.latest().version, 3)
+
+    def test_deploy_destroy_failure(self):
+        """Old containers that cannot be destroyed do not undo a deploy that is up"""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 4}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        chaos.DESTROY_ERROR_RATE = 1
+        url = "/v1/apps/{app_id}/config".format(**locals())
+        for version, strategy in ((3, 'batch'), (4, 'pipelined'), (5, 'rolling')):
+            body = {'values': json.dumps({'STRATEGY': strategy})}
+            with self.settings(DEPLOY_STRATEGY=strategy):
+                response = self.client.post(url, json.dumps(body),
+                                            content_type='application/json',
+                                            HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 201)
+            containers = Container.objects.filter(app__id=app_id, release__version=version)
+            self.assertEqual(len(containers), 4)
+            self.assertEqual(set([c.state for c in containers]), set(['up']))
+        # the old containers are left for a later cleanup
+        containers = Container.objects.filter(app__id=app_id).exclude(release__version=5)
+        self.assertEqual(set([c.state for c in containers]), set(['error']))
+        chaos.DESTROY_ERROR_RATE = 0
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 4}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        containers = Container.objects.filter(app__id=app_id)
+        self.assertEqual(set([(c.release.version, c.state) for c in containers]),
+                         set([(5, 'up')]))
+        self.assertEqual(len(containers), 4)
+
     def test_run_chaos(self):
         url = '/v1/apps'
         response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
@@ -315,3 +574,192 @@ class SchedulerTest(TransactionTestCase):
         response = self.client.post(url, json.dumps(body), content_type='application/json',
                                     HTTP_AUTHORIZATION='token {}'.format(self.token))
         self.assertEqual(response.status_code, 503)
+
+    def test_run_stream(self):
+        """A streamed run sends framed output chunks followed by a trailer"""
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        url = '/v1/apps/{app_id}/run'.format(**locals())
+        body = {'command': 'ls -al', 'stream': True}
+
+        def run_stream(self, name, image, entrypoint, command):
+            yield b'total 0\n'
+            yield b'\xe2\x9c\x93 done\n'
+            yield 3
+
+        with mock.patch('scheduler.chaos.ChaosSchedulerClient.run_stream', run_stream,
+                        create=True):
+            response = self.client.post(url, json.dumps(body),
+                                        content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.deis.run-stream')
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'8\ntotal 0\n9\n\xe2\x9c\x93 done\n0\n{"rc": 3}')
+        # schedulers without streaming support fall back to a blocking run
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(b''.join(response.streaming_content), b'0\n{"rc": 0}')
+        # failures after the response has started are reported in the trailer
+        chaos.CREATE_ERROR_RATE = 1
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0\n{"error": ""}')
+
+    def test_batch_scheduler(self):
+        """Schedulers with batch methods get one call per phase for all containers"""
+        calls = []
+
+        def create_many(self, containers):
+            calls.append(('create', len(containers)))
+            return {c['name']: None for c in containers}
+
+        def start_many(self, names):
+            calls.append(('start', len(names)))
+            # fail every other container
+            return {n: RuntimeError('boom') if i % 2 else None for i, n in enumerate(names)}
+
+        def destroy_many(self, names):
+            calls.append(('destroy', len(names)))
+            return {n: None for n in names}
+
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        # post a new build
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        with mock.patch.multiple(chaos.ChaosSchedulerClient, create=True,
+                                 create_many=create_many, start_many=start_many,
+                                 destroy_many=destroy_many):
+            # scale up, which will allow some crashed containers
+            url = "/v1/apps/{app_id}/scale".format(**locals())
+            body = {'web': 10}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(calls, [('create', 9), ('start', 9)])
+            url = "/v1/apps/{app_id}/containers".format(**locals())
+            response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 200)
+            states = [c['state'] for c in response.data['results']]
+            self.assertEqual(states.count('crashed'), 4)
+            self.assertEqual(states.count('up'), 6)
+            # scale down in a single destroy call
+            url = "/v1/apps/{app_id}/scale".format(**locals())
+            body = {'web': 0}
+            response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='token {}'.format(self.token))
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(calls[-1], ('destroy', 10))
+
+    def test_metrics(self):
+        """Scheduler operations are recorded per app and process type"""
+        metrics.reset()
+        url = '/v1/apps'
+        response = self.client.post(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = "/v1/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'sha': 'a'*40,
+                'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 201)
+        # fail every start while scaling up
+        chaos.START_ERROR_RATE = 1
+        url = "/v1/apps/{app_id}/scale".format(**locals())
+        body = {'web': 3}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 204)
+        url = '/v1/admin/scheduler/metrics'
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(self.token))
+        self.assertEqual(response.status_code, 200)
+        stats = {(s['operation'], s['app'], s['type']): s for s in response.data['operations']}
+        create = stats[('create', app_id, 'web')]
+        self.assertEqual(create['latency']['count'], 3)
+        self.assertEqual(create['errors'], 0)
+        start = stats[('start', app_id, 'web')]
+        self.assertEqual(start['latency']['count'], 3)
+        self.assertEqual(start['errors'], 2)
+        self.assertEqual(start['failures'], {'RuntimeError: ': 2})
+        self.assertEqual(len(metrics.summary()), 2)
+        # only administrators may see the metrics
+        token = Token.objects.get(user__username='autotest2').key
+        response = self.client.get(url, HTTP_AUTHORIZATION='token {}'.format(token))
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_shared(self):
+        """Scheduler metrics of every process are added up through Redis"""
+        published = {}
+        redis = mock.Mock()
+        redis.hset.side_effect = lambda key, process, data: published.__setitem__(process, data)
+        redis.hgetall.side_effect = lambda key: dict(published)
+        redis.hdel.side_effect = lambda key, *processes: [published.pop(p) for p in processes]
+        url = 'redis://localhost:6379/0'
+        worker, web = Metrics(), Metrics()
+        worker._redis[url] = web._redis[url] = redis
+        worker.observe('create', 'app_v2.web.1', 1, RuntimeError('boom'))
+        worker.observe('create', 'app_v2.web.2', 3)
+        web.observe('create', 'app_v2.web.3', 0.2)
+        web.observe('start', 'app_v2.web.3', 0.2)
+        with mock.patch.object(Metrics, '_process', staticmethod(lambda: 'host:1')):
+            worker.publish(url)
+        # a web process sees its own statistics as of now, along with the worker's
+        web.observe('start', 'app_v2.web.3', 0.2)
+        stats = {(s['operation'], s['type']): s for s in web.aggregate(url)}
+        create = stats[('create', 'web')]
+        self.assertEqual(create['latency']['count'], 3)
+        self.assertEqual(create['latency']['sum'], 4.2)
+        self.assertEqual(create['latency']['max'], 3)
+        self.assertEqual(create['latency']['mean'], 1.4)
+        self.assertEqual(create['latency']['buckets']['0.25'], 1)
+        self.assertEqual(create['latency']['buckets']['1'], 1)
+        self.assertEqual(list(create['latency']['buckets'])[-1], '+Inf')
+        self.assertEqual((create['errors'], create['failures']), (1, {'RuntimeError: boom': 1}))
+        self.assertEqual(stats[('start', 'web')]['latency']['count'], 2)
+        # processes that stopped publishing are forgotten
+        with mock.patch('time.time', return_value=time.time() + PUBLISH_INTERVAL * 4):
+            self.assertEqual(len(web.aggregate(url)), 2)
+            self.assertEqual(web.aggregate(url)[0]['latency']['count'], 1)
+        self.assertEqual(published, {})
+        # an unreachable server leaves the statistics of this process
+        redis.hgetall.side_effect = Exception('connection refused')
+        self.assertEqual(web.aggregate(url), web.snapshot())
+        self.assertEqual(web.aggregate(), web.snapshot())
+
+    def test_scheduler_registry(self):
+        """Test that one scheduler client is shared until the settings change"""
+        app = App.objects.create(owner=self.user, id='registry')
+        client = app._scheduler
+        self.assertIsInstance(client._client, chaos.ChaosSchedulerClient)
+        self.assertIs(app._scheduler, client)
+        self.assertIs(App(id='other')._scheduler, client)
+        # a new client is built for new settings, and the old one is closed
+        with mock.patch.object(chaos.ChaosSchedulerClient, 'close', create=True) as close:
+            settings.SCHEDULER_OPTIONS = {'pool_size': 5}
+            try:
+                self.assertIsNot(app._scheduler, client)
+                self.assertEqual(close.call_count, 1)
+                self.assertEqual(app._scheduler.options, {'pool_size': 5})
+            finally:
+                settings.SCHEDULER_OPTIONS = {}
+            client = app._scheduler
+            scheduler.close()
+            self.assertEqual(close.call_count, 3)
+        self.assertIsNot(app._scheduler, client)
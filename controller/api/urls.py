@@ -109,6 +109,19 @@ Application Actions
   See also
   :meth:`AppViewSet.run() <api.views.AppViewSet.run>`
 
+.. http:patch:: /v1/apps/(string:id)/rollout/
+
+  See also
+  :meth:`AppViewSet.rollout() <api.views.AppViewSet.rollout>`
+
+.. http:get:: /v1/apps/(string:id)/jobs/(string:uuid)/
+
+  Retrieve a :class:`~api.models.Job` by its `uuid`.
+
+.. http:get:: /v1/apps/(string:id)/jobs/
+
+  List all :class:`~api.models.Job`\s.
+
 
 Application Sharing
 ===================
@@ -197,6 +210,15 @@ Admin Sharing
 
   Create a new admin permission.
 
+
+Admin Monitoring
+================
+
+.. http:get:: /v1/admin/scheduler/metrics/
+
+  Retrieve latency and error statistics of scheduler operations, combined across
+  every web and job worker process that shares ``SCHEDULER_METRICS_URL``.
+
 """
 
 from __future__ import unicode_literals
@@ -249,6 +271,12 @@ urlpatterns = patterns(
         views.AppViewSet.as_view({'get': 'logs'})),
     url(r'^apps/(?P<id>{})/run/?'.format(settings.APP_URL_REGEX),
         views.AppViewSet.as_view({'post': 'run'})),
+    url(r'^apps/(?P<id>{})/rollout/?'.format(settings.APP_URL_REGEX),
+        views.AppViewSet.as_view({'patch': 'rollout'})),
+    url(r'^apps/(?P<id>{})/jobs/(?P<uuid>[-_\w]+)/?'.format(settings.APP_URL_REGEX),
+        views.AppJobViewSet.as_view({'get': 'retrieve'})),
+    url(r'^apps/(?P<id>{})/jobs/?'.format(settings.APP_URL_REGEX),
+        views.AppJobViewSet.as_view({'get': 'list'})),
     # apps sharing
     url(r'^apps/(?P<id>{})/perms/(?P<username>[-_\w]+)/?'.format(settings.APP_URL_REGEX),
         views.AppPermsViewSet.as_view({'delete': 'destroy'})),
@@ -286,4 +314,7 @@ urlpatterns = patterns(
         views.AdminPermsViewSet.as_view({'delete': 'destroy'})),
     url(r'^admin/perms/?',
         views.AdminPermsViewSet.as_view({'get': 'list', 'post': 'create'})),
+    # admin monitoring
+    url(r'^admin/scheduler/metrics/?',
+        views.SchedulerMetricsView.as_view({'get': 'list'})),
 )
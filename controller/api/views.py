@@ -5,10 +5,12 @@ RESTful view classes for presenting Deis API objects.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import json
+
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.exceptions import ValidationError
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.utils import timezone
 from guardian.shortcuts import assign_perm
 from guardian.shortcuts import get_objects_for_user
@@ -25,6 +27,34 @@ from rest_framework.response import Response
 from api import models, serializers
 from api.permissions import IsAnonymous, IsOwner, IsAppUser, \
     IsAdmin, HasRegistrationAuth, HasBuilderAuth
+from scheduler.metrics import metrics
+
+
+# content type of a streamed `run` response; see :func:`_frame_run_stream`
+RUN_STREAM_CONTENT_TYPE = 'application/vnd.deis.run-stream'
+
+
+def _frame_run_stream(stream):
+    """
+    Frame the output of a streamed one-off command for the HTTP response.
+
+    Each output chunk is sent as its length in hex and a newline, followed by the
+    chunk itself. A zero-length frame ends the output and is followed by a JSON
+    trailer holding either the exit code as ``rc`` or the failure as ``error``.
+    """
+    trailer = {}
+    try:
+        for item in stream:
+            if isinstance(item, int):
+                trailer['rc'] = item
+                continue
+            if isinstance(item, unicode):
+                item = item.encode('utf-8')
+            if item:
+                yield b'{:x}\n'.format(len(item)) + item
+    except Exception as e:
+        trailer['error'] = str(e)
+    yield b'0\n' + json.dumps(trailer).encode('utf-8')
 
 
 class AnonymousAuthentication(BaseAuthentication):
@@ -154,6 +184,16 @@ class AdminPermsViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class SchedulerMetricsView(viewsets.ViewSet):
+    """RESTful views for scheduler operation statistics."""
+
+    permission_classes = (IsAdmin,)
+
+    def list(self, request, **kwargs):
+        operations = metrics.aggregate(settings.SCHEDULER_METRICS_URL)
+        return Response({'operations': operations}, status=status.HTTP_200_OK)
+
+
 class AppViewSet(OwnerViewSet):
     """RESTful views for :class:`~api.models.App`."""
 
@@ -173,6 +213,15 @@ class AppViewSet(OwnerViewSet):
         if created:
             app.create()
 
+    def rollout(self, request, **kwargs):
+        """Change the rollout settings of an app; a null value unsets a setting."""
+        app = self.get_object()
+        serializer = self.get_serializer(app, data={'rollout': request.DATA}, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        serializer.save()
+        return Response(serializer.data['rollout'], status=status.HTTP_200_OK)
+
     def scale(self, request, **kwargs):
         new_structure = {}
         try:
@@ -184,11 +233,14 @@ class AppViewSet(OwnerViewSet):
         app = self.get_object()
         try:
             models.validate_app_structure(new_structure)
-            app.scale(request.user, new_structure)
+            job = app.submit(request.user, 'scale', structure=new_structure)
         except (EnvironmentError, ValidationError) as e:
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
         except RuntimeError as e:
             return Response(str(e), status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if job is not None:
+            return Response(serializers.JobSerializer(job).data,
+                            status=status.HTTP_202_ACCEPTED)
         return Response(status=status.HTTP_204_NO_CONTENT,
                         content_type='application/json')
 
@@ -207,6 +259,10 @@ class AppViewSet(OwnerViewSet):
         app = self.get_object()
         command = request.DATA['command']
         try:
+            if request.DATA.get('stream'):
+                stream = app.run_stream(self.request.user, command)
+                return StreamingHttpResponse(_frame_run_stream(stream),
+                                             content_type=RUN_STREAM_CONTENT_TYPE)
             output_and_rc = app.run(self.request.user, command)
         except EnvironmentError as e:
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
@@ -224,6 +280,8 @@ class AppViewSet(OwnerViewSet):
 class BaseAppViewSet(viewsets.ModelViewSet):
 
     permission_classes = (permissions.IsAuthenticated, IsAppUser)
+    # the job deploying a newly created object, if deploys run in the background
+    job = None
 
     def pre_save(self, obj):
         obj.owner = self.request.user
@@ -242,6 +300,18 @@ class BaseAppViewSet(viewsets.ModelViewSet):
         self.check_object_permissions(self.request, obj)
         return obj
 
+    def get_success_headers(self, data):
+        headers = super(BaseAppViewSet, self).get_success_headers(data)
+        if self.job is not None:
+            headers.update({'X-Deis-Job': self.job.uuid})
+        return headers
+
+    def create(self, request, *args, **kwargs):
+        response = super(BaseAppViewSet, self).create(request, *args, **kwargs)
+        if self.job is not None:
+            response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
 
 class AppBuildViewSet(BaseAppViewSet):
     """RESTful views for :class:`~api.models.Build`."""
@@ -251,7 +321,7 @@ class AppBuildViewSet(BaseAppViewSet):
 
     def post_save(self, build, created=False):
         if created:
-            self.release = build.create(self.request.user)
+            self.release, self.job = build.create(self.request.user)
 
     def get_success_headers(self, data):
         headers = super(AppBuildViewSet, self).get_success_headers(data)
@@ -310,11 +380,7 @@ class AppConfigViewSet(BaseAppViewSet):
         if created:
             release = config.app.release_set.latest()
             self.release = release.new(self.request.user, config=config, build=release.build)
-            try:
-                config.app.deploy(self.request.user, self.release)
-            except RuntimeError:
-                self.release.delete()
-                raise
+            self.job = config.app.submit(self.request.user, 'deploy', release=self.release)
 
     def get_success_headers(self, data):
         headers = super(AppConfigViewSet, self).get_success_headers(data)
@@ -351,13 +417,15 @@ class AppReleaseViewSet(BaseAppViewSet):
             version_to_rollback_to = release.version - 1
             if request.DATA.get('version'):
                 version_to_rollback_to = int(request.DATA['version'])
-            new_release = release.rollback(request.user, version_to_rollback_to)
+            new_release, job = release.rollback(request.user, version_to_rollback_to)
             response = {'version': new_release.version}
+            if job is not None:
+                response['job'] = job.uuid
+                return Response(response, status=status.HTTP_202_ACCEPTED)
             return Response(response, status=status.HTTP_201_CREATED)
         except EnvironmentError as e:
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
         except RuntimeError as e:
-            new_release.delete()
             return Response(str(e), status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
@@ -382,6 +450,17 @@ class AppContainerViewSet(BaseAppViewSet):
         return obj
 
 
+class AppJobViewSet(BaseAppViewSet):
+    """RESTful views for :class:`~api.models.Job`."""
+
+    model = models.Job
+    serializer_class = serializers.JobSerializer
+
+    def get_object(self, *args, **kwargs):
+        """Get Job by uuid always."""
+        return get_object_or_404(self.get_queryset(), uuid=self.kwargs['uuid'])
+
+
 class KeyViewSet(OwnerViewSet):
     """RESTful views for :class:`~api.models.Key`."""
 
@@ -416,6 +495,8 @@ class DomainViewSet(OwnerViewSet):
 class BaseHookViewSet(viewsets.ModelViewSet):
 
     permission_classes = (HasBuilderAuth,)
+    # the job deploying a newly created object, if deploys run in the background
+    job = None
 
     def pre_save(self, obj):
         # SECURITY: we trust the username field to map to the owner
@@ -465,6 +546,9 @@ class BuildHookViewSet(BaseHookViewSet):
                 # return the application databag
                 response = {'release': {'version': app.release_set.latest().version},
                             'domains': ['.'.join([app.id, settings.DEIS_DOMAIN])]}
+                if self.job is not None:
+                    response['job'] = self.job.uuid
+                    return Response(response, status=status.HTTP_202_ACCEPTED)
                 return Response(response, status=status.HTTP_200_OK)
             except RuntimeError as e:
                 return Response(str(e), status=status.HTTP_503_SERVICE_UNAVAILABLE)
@@ -472,7 +556,7 @@ class BuildHookViewSet(BaseHookViewSet):
 
     def post_save(self, build, created=False):
         if created:
-            build.create(self.user)
+            self.release, self.job = build.create(self.user)
 
 
 class ConfigHookViewSet(BaseHookViewSet):
@@ -258,6 +258,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'scheduler': {
+            'handlers': ['console', 'rsyslog'],
+            'level': 'INFO',
+            'propagate': True,
+        },
     }
 }
 TEST_RUNNER = 'api.tests.SilentDjangoTestSuiteRunner'
@@ -280,6 +285,32 @@ SCHEDULER_MODULE = 'mock'
 SCHEDULER_TARGET = ''  # path to scheduler endpoint (e.g. /var/run/fleet.sock)
 SCHEDULER_AUTH = ''
 SCHEDULER_OPTIONS = {}
+# maximum number of scheduler calls in flight per process, and per app
+SCHEDULER_CONCURRENCY = 50
+SCHEDULER_APP_CONCURRENCY = 20
+# URL of a Redis server (e.g. "redis://localhost:6379/0") through which every process
+# shares its scheduler metrics; without it, each process only reports its own
+SCHEDULER_METRICS_URL = ''
+# how deploys replace containers: "batch" creates all new containers, then starts
+# them all, then destroys all old ones; "pipelined" replaces each one on its own;
+# "rolling" replaces them in batches bounded by the limits below
+DEPLOY_STRATEGY = 'batch'
+# roll back a deploy if any new container fails to create
+DEPLOY_ATOMIC = True
+# default limits of rolling deploys, which apps may override: how many containers
+# may run beyond an app's structure, and how many fewer may be in service
+DEPLOY_MAX_SURGE = 1
+DEPLOY_MAX_UNAVAILABLE = 0
+# queue scales and deploys for the "jobworker" command instead of running them
+# within the request, which then answers 202 Accepted with the job
+ASYNC_JOBS = False
+# number of worker processes started by "jobworker", and how often (seconds)
+# an idle worker looks for new jobs
+JOB_WORKERS = 4
+JOB_POLL_INTERVAL = 1
+# how often (seconds) the job worker corrects the state of containers that
+# crashed or vanished behind the API's back; 0 disables it
+RECONCILE_INTERVAL = 0
 
 # security keys and auth tokens
 SSH_PRIVATE_KEY = ''  # used for SSH connections to facilitate "deis run"
@@ -291,6 +322,19 @@ REGISTRY_MODULE = 'registry.mock'
 REGISTRY_URL = 'http://localhost:5000'
 REGISTRY_HOST = 'localhost'
 REGISTRY_PORT = 5000
+# connections kept open to the registry per process, the timeout (seconds) of each
+# registry call, and how often a call that failed to connect or got a server error
+# is retried, waiting REGISTRY_RETRY_BACKOFF seconds and twice as long each time
+REGISTRY_POOL_SIZE = 10
+REGISTRY_TIMEOUT = 60
+REGISTRY_RETRIES = 3
+REGISTRY_RETRY_BACKOFF = 0.5
+# number of image and tag lookups cached per process, the URL of a Redis server
+# (e.g. "redis://localhost:6379/0") that shares them between processes, and how
+# long (seconds) each lookup is cached
+REGISTRY_CACHE_SIZE = 1000
+REGISTRY_CACHE_URL = ''
+REGISTRY_CACHE_TTL = 86400
 
 # check if we can register users with `deis register`
 REGISTRATION_ENABLED = True
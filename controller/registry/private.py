@@ -1,8 +1,13 @@
+import collections
 import cStringIO
 import hashlib
 import json
+import logging
+import re
 import requests
 import tarfile
+import threading
+import time
 import urlparse
 import uuid
 
@@ -12,6 +17,9 @@ from docker.utils import utils
 from api.utils import encode
 
 
+logger = logging.getLogger(__name__)
+
+
 def publish_release(source, config, target):
     """
     Publish a new release as a Docker image
@@ -69,11 +77,83 @@ def publish_release(source, config, target):
 
 def _commit(repository_path, image, layer, tag):
     _put_image(image)
-    cookies = _put_layer(image['id'], layer)
-    _put_checksum(image, cookies)
+    # the layer is hashed as it is uploaded
+    tarsum = TarSum(json.dumps(image))
+    cookies = _put_layer(image['id'], layer, tarsum)
+    _put_checksum(image, cookies, tarsum)
     _put_tag(image['id'], repository_path, tag)
 
 
+class MetadataCache(object):
+    """A thread-safe LRU cache of registry metadata, optionally shared through Redis.
+
+    Values are kept as JSON text, so every lookup returns a fresh copy that the
+    caller is free to change, and expire `ttl` seconds after they were cached.
+    Redis is only an addition: when it cannot be reached, the cache carries on
+    with what this process knows.
+    """
+
+    def __init__(self, size, url='', ttl=None):
+        self.size = size
+        self.url = url
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+
+    def _shared(self):
+        if self._redis is None and self.url:
+            import redis
+            self._redis = redis.StrictRedis.from_url(self.url)
+        return self._redis
+
+    def get(self, key):
+        """Return the value cached for `key`, or None."""
+        with self._lock:
+            data, expires = self._items.pop(key, (None, None))
+            if expires is not None and expires <= time.time():
+                data = None
+            elif data is not None:
+                self._items[key] = data, expires
+        if data is None and self.url:
+            try:
+                data = self._shared().get('deis:registry:' + key)
+            except Exception as e:
+                logger.warning('registry cache unavailable: {}'.format(e))
+            if data is not None:
+                self._remember(key, data)
+        return json.loads(data) if data is not None else None
+
+    def set(self, key, value):
+        """Cache `value` for `key`."""
+        data = json.dumps(value)
+        self._remember(key, data)
+        if self.url:
+            try:
+                self._shared().set('deis:registry:' + key, data, ex=self.ttl)
+            except Exception as e:
+                logger.warning('registry cache unavailable: {}'.format(e))
+
+    def _remember(self, key, data):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = data, expires
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+# image JSON never changes for a given id; of the tags, only release tags are
+# cached, since builds and imports may move any other tag
+_cache = MetadataCache(settings.REGISTRY_CACHE_SIZE, settings.REGISTRY_CACHE_URL,
+                       settings.REGISTRY_CACHE_TTL)
+_RELEASE_TAG = re.compile(r'^v[0-9]+$')
+
+
+def _tag_key(repository, tag):
+    return 'tag:{}:{}'.format(repository, tag)
+
+
 def _put_first_image(repository_path):
     image = {
         'id': _new_id(),
@@ -86,38 +166,85 @@ def _put_first_image(repository_path):
     _commit(repository_path, image, _empty_tar_archive(), 'v0')
 
 
+# connections to the registry are pooled by one adapter shared by all threads; each
+# thread has a session of its own, so the cookies of an upload are not shared
+_adapter = None
+_adapter_lock = threading.Lock()
+_sessions = threading.local()
+
+
+def _session():
+    "Return this thread's session, which keeps its connections to the registry alive"
+    global _adapter
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=settings.REGISTRY_POOL_SIZE)
+        session = requests.Session()
+        session.mount('http://', _adapter)
+        session.mount('https://', _adapter)
+        _sessions.session = session
+    return session
+
+
 def _api_call(endpoint, data=None, headers={}, cookies=None, request_type='GET'):
     # FIXME: update API calls for docker 0.10.0+
     base_headers = {'user-agent': 'docker/0.9.0'}
-    r = None
     if len(headers) > 0:
         for header, value in headers.iteritems():
             base_headers[header] = value
-    if request_type == 'GET':
-        r = requests.get(endpoint, headers=base_headers)
-    elif request_type == 'PUT':
-        r = requests.put(endpoint, data=data, headers=base_headers, cookies=cookies)
-    else:
+    if request_type not in ('GET', 'PUT'):
         raise AttributeError("request type not supported: {}".format(request_type))
-    return r
+    # registry calls are idempotent, so retry those that failed on the way, unless
+    # their data is streamed and cannot be sent again
+    retries = settings.REGISTRY_RETRIES
+    if data is not None and not isinstance(data, basestring):
+        retries = 0
+    attempt = 0
+    while True:
+        try:
+            r = _session().request(request_type, endpoint, data=data, headers=base_headers,
+                                   cookies=cookies, timeout=settings.REGISTRY_TIMEOUT)
+            if r.status_code < 500 or attempt >= retries:
+                return r
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= retries:
+                raise
+        time.sleep(settings.REGISTRY_RETRY_BACKOFF * 2 ** attempt)
+        attempt += 1
 
 
 def _get_tag(repository, tag):
+    cacheable = _RELEASE_TAG.match(tag) is not None
+    if cacheable:
+        image_id = _cache.get(_tag_key(repository, tag))
+        if image_id is not None:
+            return image_id
     path = "/v1/repositories/{repository}/tags/{tag}".format(**locals())
     url = urlparse.urljoin(settings.REGISTRY_URL, path)
     r = _api_call(url)
     if not r.status_code == 200:
         raise RuntimeError("GET Image Error ({}: {})".format(r.status_code, r.text))
-    return r.json()
+    image_id = r.json()
+    if cacheable:
+        _cache.set(_tag_key(repository, tag), image_id)
+    return image_id
 
 
 def _get_image(image_id):
+    image = _cache.get('image:' + image_id)
+    if image is not None:
+        return image
     path = "/v1/images/{image_id}/json".format(**locals())
     url = urlparse.urljoin(settings.REGISTRY_URL, path)
     r = _api_call(url)
     if not r.status_code == 200:
         raise RuntimeError("GET Image Error ({}: {})".format(r.status_code, r.text))
-    return r.json()
+    image = r.json()
+    _cache.set('image:' + image_id, image)
+    return image
 
 
 def _put_image(image):
@@ -126,22 +253,25 @@ def _put_image(image):
     r = _api_call(url, data=json.dumps(image), request_type='PUT')
     if not r.status_code == 200:
         raise RuntimeError("PUT Image Error ({}: {})".format(r.status_code, r.text))
+    _cache.set('image:' + image['id'], image)
     return r.json()
 
 
-def _put_layer(image_id, layer_fileobj):
+def _put_layer(image_id, layer_fileobj, tarsum=None):
     path = "/v1/images/{image_id}/layer".format(**locals())
     url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    r = _api_call(url, data=layer_fileobj.read(), request_type='PUT')
+    # send the layer in chunks as it is read, so it never has to fit in memory
+    data = _stream_layer(layer_fileobj, tarsum or TarSum(''))
+    r = _api_call(url, data=data, request_type='PUT')
     if not r.status_code == 200:
         raise RuntimeError("PUT Layer Error ({}: {})".format(r.status_code, r.text))
     return r.cookies
 
 
-def _put_checksum(image, cookies):
+def _put_checksum(image, cookies, tarsum=None):
     path = "/v1/images/{id}/checksum".format(**image)
     url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    tarsum = TarSum(json.dumps(image)).compute()
+    tarsum = (tarsum or TarSum(json.dumps(image))).compute()
     headers = {'X-Docker-Checksum': tarsum}
     r = _api_call(url, headers=headers, cookies=cookies, request_type='PUT')
     if not r.status_code == 200:
@@ -155,6 +285,8 @@ def _put_tag(image_id, repository_path, tag):
     r = _api_call(url, data=json.dumps(image_id), request_type='PUT')
     if not r.status_code == 200:
         raise RuntimeError("PUT Tag Error ({}: {})".format(r.status_code, r.text))
+    if _RELEASE_TAG.match(tag):
+        _cache.set(_tag_key(repository_path, tag), image_id)
     print r.json()
 
 
@@ -176,30 +308,90 @@ def _construct_env(env, config):
     return new_env
 
 
+class _TeeReader(object):
+    "File object that keeps what is read from `fileobj` until it is drained"
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._read = []
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._read.append(data)
+        return data
+
+    def drain(self):
+        data = ''.join(self._read)
+        self._read = []
+        return data
+
+
+def _stream_layer(layer_fileobj, tarsum):
+    """
+    Yield the tar archive `layer_fileobj` in chunks of about CHUNK_SIZE bytes,
+    adding its members to `tarsum` on the way.
+
+    The archive is read once, as a stream, and no more than a chunk of it is held
+    in memory at a time.
+    """
+    tee = _TeeReader(layer_fileobj)
+    tar = tarfile.open(mode='r|', fileobj=tee, bufsize=CHUNK_SIZE)
+    for member in tar:
+        h = tarsum.member_hash(member)
+        f = tar.extractfile(member) if member.isreg() and member.size > 0 else None
+        while f is not None:
+            buf = f.read(CHUNK_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+            data = tee.drain()
+            if data:
+                yield data
+        tarsum.hashes.append(h.hexdigest())
+    # the end of archive marker and padding
+    while tee.read(CHUNK_SIZE):
+        data = tee.drain()
+        if data:
+            yield data
+    data = tee.drain()
+    if data:
+        yield data
+
+
 def _new_id():
     "Return 64-char UUID for use as Image ID"
     return ''.join(uuid.uuid4().hex * 2)
 
 
-def _empty_tar_archive():
-    "Return an empty tar archive (in memory)"
+def _build_empty_tar():
     data = cStringIO.StringIO()
     tar = tarfile.open(mode="w", fileobj=data)
     tar.close()
-    data.seek(0)
-    return data
+    return data.getvalue()
+
+
+# every config release adds the same empty layer, so build it only once
+_EMPTY_TAR = _build_empty_tar()
+
+
+def _empty_tar_archive():
+    "Return an empty tar archive (in memory)"
+    return cStringIO.StringIO(_EMPTY_TAR)
 
 
 #
 # Below adapted from https://github.com/dotcloud/docker-registry/blob/master/lib/checksums.py
 #
 
+CHUNK_SIZE = 1024 * 1024
+
+
 def sha256_file(fp, data=None):
     h = hashlib.sha256(data or '')
     if not fp:
         return h.hexdigest()
     while True:
-        buf = fp.read(4096)
+        buf = fp.read(CHUNK_SIZE)
         if not buf:
             break
         h.update(buf)
@@ -219,7 +411,7 @@ class TarSum(object):
                               'type', 'linkname', 'uname', 'gname', 'devmajor',
                               'devminor')
 
-    def append(self, member, tarobj):
+    def header(self, member):
         header = ''
         for field in self.header_fields:
             value = getattr(member, field)
@@ -229,6 +421,14 @@ class TarSum(object):
                 if member.isdir() and not value.endswith('/'):
                     value += '/'
             header += '{0}{1}'.format(field, value)
+        return header
+
+    def member_hash(self, member):
+        "Return a running hash of `member`, to be updated with its contents"
+        return hashlib.sha256(self.header(member))
+
+    def append(self, member, tarobj):
+        header = self.header(member)
         h = None
         try:
             if member.size > 0:
@@ -0,0 +1,56 @@
+"""
+Scheduler backends for the controller.
+
+Each module provides a ``SchedulerClient`` class. Clients are not built per
+operation: :func:`get_client` shares one client per scheduler configuration
+across the whole process, so connections and caches can be reused.
+"""
+
+import importlib
+import json
+import threading
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(module, target, auth, options, pkey, wrap=None):
+    """
+    Return the client of scheduler `module` (e.g. "fleet") for the given settings.
+
+    The client is built on first use and then shared. A call with different
+    settings builds a new client and closes the ones built for other settings;
+    closing only releases idle resources, so operations still running on an old
+    client are not disturbed. `wrap`, if given, is applied to a new client.
+    """
+    key = (module, target, auth, json.dumps(options, sort_keys=True), pkey)
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+        stale = _clients.values()
+        _clients.clear()
+        mod = importlib.import_module('scheduler.' + module)
+        client = mod.SchedulerClient(target, auth, options, pkey)
+        if wrap is not None:
+            client = wrap(client)
+        _clients[key] = client
+    for old in stale:
+        _close(old)
+    return client
+
+
+def close():
+    """Close and forget every shared client; the next :func:`get_client` builds a new one."""
+    with _lock:
+        clients = _clients.values()
+        _clients.clear()
+    for client in clients:
+        _close(client)
+
+
+def _close(client):
+    close = getattr(client, 'close', None)
+    if close is not None:
+        close()
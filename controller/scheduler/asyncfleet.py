@@ -0,0 +1,330 @@
+import asyncore
+import cStringIO
+import collections
+import heapq
+import httplib
+import json
+import socket
+import sys
+import time
+
+from scheduler import fleet
+from scheduler.fleet import CONTAINER_TEMPLATE, FAILED_GRACE, POOL_SIZE, RETRIES
+from scheduler.metrics import metrics
+
+# how long a single request may take before fleet is considered unresponsive
+REQUEST_TIMEOUT = 30
+
+
+class _FakeSocket(object):
+    """Let :class:`httplib.HTTPResponse` parse a response that was already received."""
+
+    def __init__(self, raw):
+        self._file = cStringIO.StringIO(raw)
+
+    def makefile(self, *args, **kwargs):
+        return self._file
+
+
+class _HTTPRequest(asyncore.dispatcher):
+    """A single non-blocking HTTP request over the fleet Unix domain socket.
+
+    The connection is closed by fleet after the response, which tells us the
+    response is complete; `callback` is then called with ``(resp, data, error)``.
+    A request still unanswered at `deadline` fails with :class:`socket.timeout`.
+    """
+
+    def __init__(self, path, method, url, body, callback, map, deadline):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.callback = callback
+        self.deadline = deadline
+        self.inbuf = []
+        headers = ['{} {} HTTP/1.1'.format(method, url),
+                   'Host: localhost',
+                   'Content-Type: application/json',
+                   'Content-Length: {}'.format(len(body or '')),
+                   'Connection: close']
+        self.outbuf = '\r\n'.join(headers) + '\r\n\r\n' + (body or '')
+        self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.connect(path)
+        except socket.error:
+            self.close()
+            raise
+
+    def _done(self, error=None):
+        self.close()
+        callback, self.callback = self.callback, None
+        if callback is None:
+            return
+        resp = data = None
+        if error is None:
+            try:
+                resp = httplib.HTTPResponse(_FakeSocket(''.join(self.inbuf)))
+                resp.begin()
+                data = resp.read()
+            except Exception as e:
+                error = e
+        callback(resp, data, error)
+
+    def expire(self):
+        self._done(socket.timeout('no response from fleet'))
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self.outbuf) or not self.connected
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        self.inbuf.append(self.recv(65536))
+
+    def handle_close(self):
+        self._done()
+
+    def handle_error(self):
+        self._done(sys.exc_info()[1])
+
+
+class _EventLoop(object):
+    """A minimal event loop multiplexing fleet requests and timers in one thread."""
+
+    def __init__(self, path, limit, timeout=REQUEST_TIMEOUT):
+        self.path = path
+        self.limit = limit
+        self.timeout = timeout
+        self.map = {}
+        self.queue = collections.deque()
+        self.timers = []
+        self._seq = 0
+
+    def request(self, method, url, callback, body=None):
+        """Queue a request; at most `limit` are in flight at any time."""
+        self.queue.append((method, url, body, callback))
+
+    def call_later(self, delay, callback):
+        self._seq += 1
+        heapq.heappush(self.timers, (time.time() + delay, self._seq, callback))
+
+    def run(self, done):
+        """Process requests and timers until `done()` returns True."""
+        while not done():
+            while self.queue and len(self.map) < self.limit:
+                method, url, body, callback = self.queue.popleft()
+                try:
+                    _HTTPRequest(self.path, method, url, body, callback, self.map,
+                                 time.time() + self.timeout)
+                except socket.error as e:
+                    callback(None, None, e)
+            now = time.time()
+            for req in self.map.values():
+                if req.deadline <= now:
+                    req.expire()
+            while self.timers and self.timers[0][0] <= now:
+                heapq.heappop(self.timers)[2]()
+            if done():
+                break
+            wakeups = [t[0] for t in self.timers[:1]] + [r.deadline for r in self.map.values()]
+            timeout = min([w - now for w in wakeups] + [1])
+            if self.map:
+                asyncore.loop(timeout=max(timeout, 0), use_poll=True, map=self.map, count=1)
+            elif not self.queue:
+                time.sleep(max(timeout, 0))
+
+
+class AsyncFleetClient(fleet.FleetHTTPClient):
+    """Fleet scheduler that drives many units from a single event loop.
+
+    The batch methods (:meth:`create_many`, :meth:`start_many` and
+    :meth:`destroy_many`) issue all fleet requests for a set of units without one
+    thread per container. They return a dict mapping each unit name to the error
+    it failed with, or None. The single-unit methods are thin wrappers around
+    them, and one-off commands use the blocking client.
+    """
+
+    def _loop(self):
+        return _EventLoop(self.target, int(self.options.get('pool_size', POOL_SIZE)),
+                          float(self.options.get('request_timeout', REQUEST_TIMEOUT)))
+
+    def _request(self, loop, method, url, check, callback, body=None, attempt=0,
+                 operation=None, name=None):
+        """Send a request through `loop`, retrying up to RETRIES times on failure.
+
+        Retries back off following the wait policy and are recorded against
+        `operation` on container `name`, if given.
+        """
+        def on_response(resp, data, error):
+            if error is None and not check(resp.status):
+                error = RuntimeError('{} {} - {}'.format(resp.status, resp.reason, data))
+            if error is not None and attempt < RETRIES - 1:
+                if operation is not None:
+                    metrics.retry(operation, name, error)
+                delay = min(self.policy.first * self.policy.factor ** attempt,
+                            self.policy.ceiling)
+                loop.call_later(self.policy.jittered(delay), lambda: self._request(
+                    loop, method, url, check, callback, body, attempt + 1, operation, name))
+                return
+            callback(data, error)
+        loop.request(method, url, on_response, body)
+
+    def _get_states(self, loop, callback, states=None, url='/v1-alpha/state'):
+        """Fetch every page of unit states, then call ``callback(states, error)``."""
+        states = {} if states is None else states
+
+        def on_page(data, error):
+            if error is not None:
+                callback(None, error)
+                return
+            page = json.loads(data)
+            for state in page.get('states', []):
+                states[state['name'].rsplit('.service', 1)[0]] = state
+            token = page.get('nextPageToken')
+            if token:
+                self._get_states(loop, callback, states,
+                                 '/v1-alpha/state?nextPageToken={}'.format(token))
+            else:
+                callback(states, None)
+        self._request(loop, 'GET', url, lambda s: s == 200, on_page)
+
+    def _poll(self, loop, operation, names, check, timeout):
+        """Poll the state of all units in `names` until `check` settles them.
+
+        `check(name, state)` returns an error, False for success, or None while
+        the unit should still be watched; `state` is None for a unit fleet does not
+        know about. Units left over when `timeout` expires are returned as a set
+        alongside the errors.
+        """
+        errors, pending = {}, set(names)
+        deadline = time.time() + timeout
+        delays = self.poll_policy.delays(timeout)
+        failures = [0]
+
+        def on_states(states, error):
+            if error is not None:
+                failures[0] += 1
+                if failures[0] >= RETRIES:
+                    errors.update((name, error) for name in pending)
+                    pending.clear()
+                    return
+            else:
+                failures[0] = 0
+                for name in list(pending):
+                    metrics.poll(operation, name)
+                    result = check(name, states.get(name))
+                    if result is not None:
+                        errors[name] = result or None
+                        pending.discard(name)
+            schedule()
+
+        def schedule():
+            delay = next(delays, None)
+            if pending and delay is not None:
+                loop.call_later(delay, lambda: self._get_states(loop, on_states))
+
+        schedule()
+        loop.run(lambda: not pending or (time.time() >= deadline and not loop.map))
+        return errors, pending
+
+    # batch container api
+
+    def create_many(self, containers):
+        """Create many containers.
+
+        Each item in `containers` is a dict of keyword arguments for :meth:`create`;
+        a name that appears more than once is only created once.
+        """
+        loop, errors, pending = self._loop(), {}, set()
+        for c in containers:
+            c = c.copy()
+            name, image = c.pop('name'), c.pop('image')
+            if name in errors or name in pending:
+                continue
+            command = c.pop('command', '')
+            template = c.pop('template', None) or CONTAINER_TEMPLATE
+            try:
+                unit = self._build_unit(name, image, command, template, **c)
+            except Exception as e:
+                errors[name] = e
+                continue
+            body = json.dumps({"desiredState": "launched", "options": unit})
+
+            def on_put(data, error, name=name):
+                pending.discard(name)
+                errors[name] = error and RuntimeError(
+                    'Failed to create unit: {}'.format(error))
+            pending.add(name)
+            self._request(loop, 'PUT', '/v1-alpha/units/{}.service'.format(name),
+                          lambda s: 200 <= s <= 299, on_put, body,
+                          operation='create', name=name)
+        loop.run(lambda: not pending)
+        return errors
+
+    def start_many(self, names):
+        """Wait for many containers to start."""
+        began, failed_since = time.time(), {}
+
+        def check(name, state):
+            if state is None:
+                return None
+            subState = state.get('systemdSubState')
+            if subState == 'running' or subState == 'exited':
+                self._log_phases(name, [(subState, time.time() - began)])
+                return False
+            elif subState == 'failed':
+                # FIXME: fleet unit state reports failed when containers are fine
+                since = failed_since.setdefault(name, time.time())
+                if time.time() - since >= FAILED_GRACE:
+                    return RuntimeError('container failed to start')
+            else:
+                failed_since.pop(name, None)
+            return None
+
+        errors, pending = self._poll(self._loop(), 'start', names, check,
+                                     self.timeouts['start'])
+        for name in pending:
+            errors[name] = RuntimeError('container timeout on start')
+        return errors
+
+    def destroy_many(self, names):
+        """Destroy many containers."""
+        loop, deleted = self._loop(), set()
+        for name in names:
+            # ignore delete errors; a unit that survives is caught below
+            self._request(loop, 'DELETE', '/v1-alpha/units/{}.service'.format(name),
+                          lambda s: s in (404, 204),
+                          lambda data, error, name=name: deleted.add(name),
+                          operation='destroy', name=name)
+        loop.run(lambda: len(deleted) == len(set(names)))
+
+        def check(name, state):
+            return False if state is None else None
+
+        errors, pending = self._poll(loop, 'destroy', names, check, self.timeouts['destroy'])
+        for name in pending:
+            errors[name] = RuntimeError('timeout on container destroy')
+        return errors
+
+    # container api
+
+    def create(self, name, image, command='', template=None, **kwargs):
+        """Create a container"""
+        kwargs.update(name=name, image=image, command=command, template=template)
+        self._raise(self.create_many([kwargs]), name)
+
+    def start(self, name):
+        """Start a container"""
+        self._raise(self.start_many([name]), name)
+
+    def destroy(self, name):
+        """Destroy a container"""
+        self._raise(self.destroy_many([name]), name)
+
+    def _raise(self, errors, name):
+        if errors.get(name):
+            raise errors[name]
+
+SchedulerClient = AsyncFleetClient
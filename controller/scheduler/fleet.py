@@ -1,17 +1,51 @@
 import cStringIO
 import base64
-import copy
+import collections
+import contextlib
 import json
 import httplib
+import logging
 import paramiko
+import random
 import socket
 import re
+import threading
 import time
 
+from scheduler.metrics import metrics
 
 MATCH = re.compile(
     '(?P<app>[a-z0-9-]+)_?(?P<version>v[0-9]+)?\.?(?P<c_type>[a-z-_]+)?.(?P<c_num>[0-9]+)')
 RETRIES = 3
+POOL_SIZE = 20
+POOL_IDLE_TIMEOUT = 60
+TEMPLATE_CACHE_SIZE = 256
+SSH_KEEPALIVE = 30
+SSH_IDLE_TIMEOUT = 300
+RUN_CHUNK_SIZE = 32768
+MACHINE_TTL = 30
+# default wait policy (seconds) for polling fleet and docker
+WAIT_FIRST = 0.1
+WAIT_FACTOR = 2
+WAIT_CEILING = 5
+WAIT_JITTER = 0.2
+# default deadlines (seconds) for each wait phase
+START_TIMEOUT = 1200  # matches the timeout on the router and in the app unit files
+DESTROY_TIMEOUT = 30
+SCHEDULE_TIMEOUT = 30
+RUN_TIMEOUT = 1200
+# how long a unit may keep reporting "failed" before we believe it
+FAILED_GRACE = 10
+# container states reported for settled systemd sub-states of a unit
+UNIT_STATES = {
+    'running': 'up',
+    'exited': 'up',
+    'failed': 'crashed',
+    'dead': 'down',
+}
+
+
+logger = logging.getLogger(__name__)
 
 
 class UHTTPConnection(httplib.HTTPConnection):
@@ -28,6 +62,501 @@ class UHTTPConnection(httplib.HTTPConnection):
         self.sock = sock
 
 
+class UHTTPConnectionPool(object):
+    """A bounded, thread-safe pool of keep-alive :class:`UHTTPConnection`\s.
+
+    At most `size` connections are checked out at once; callers beyond that block
+    until a connection is returned. Idle connections older than `idle_timeout`
+    seconds are closed instead of reused, and a request that fails on a reused
+    connection (e.g. a broken pipe after fleet closed it) is retried once on a
+    fresh one.
+    """
+
+    def __init__(self, path, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _get(self):
+        self._slots.acquire()
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return UHTTPConnection(self.path), False
+
+    def _put(self, conn, reuse):
+        if reuse:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        else:
+            conn.close()
+        self._slots.release()
+
+    def request(self, method, url, body=None, headers={}):
+        """Send a request and return the response along with its body."""
+        conn, reused = self._get()
+        reuse = False
+        try:
+            while True:
+                try:
+                    conn.request(method, url, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    break
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # the server dropped our keep-alive connection; reconnect once
+                    reused = False
+            reuse = not resp.will_close
+            return resp, data
+        finally:
+            self._put(conn, reuse)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+
+
+class SSHTransportPool(object):
+    """A thread-safe pool of authenticated SSH transports, one per host.
+
+    `deis run` opens its channels over a pooled transport instead of doing a full
+    SSH handshake every time. Transports are kept alive with SSH keepalives while
+    pooled and closed by a background reaper once they have been unused for
+    `idle_timeout` seconds; a transport that has died is replaced on checkout.
+    """
+
+    def __init__(self, keepalive=SSH_KEEPALIVE, idle_timeout=SSH_IDLE_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._hosts = {}  # (host, username) -> _SSHHost
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _connect(self, host, username, pkey):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(host, username=username, pkey=pkey)
+        ssh.get_transport().set_keepalive(int(self.keepalive))
+        return ssh
+
+    @contextlib.contextmanager
+    def transport(self, host, pkey, username='core'):
+        """Check out the :class:`paramiko.Transport` to `host` for the duration of a block."""
+        with self._lock:
+            entry = self._hosts.get((host, username))
+            if entry is None:
+                entry = self._hosts[(host, username)] = _SSHHost()
+            entry.users += 1
+            self._start_reaper()
+        try:
+            # serialize handshakes so concurrent runs on a new host share one transport
+            with entry.lock:
+                tran = entry.ssh and entry.ssh.get_transport()
+                if tran is None or not tran.is_active():
+                    if entry.ssh is not None:
+                        entry.ssh.close()
+                        entry.ssh = None
+                    entry.ssh = self._connect(host, username, pkey)
+                    tran = entry.ssh.get_transport()
+            yield tran
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.time()
+
+    def _start_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap, name='ssh-reaper')
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2.0, 1))
+            if not self.evict():
+                return
+
+    def evict(self, idle_timeout=None):
+        """Close transports idle for longer than `idle_timeout`; return how many remain."""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.time()
+        with self._lock:
+            for key, entry in self._hosts.items():
+                if entry.users == 0 and now - entry.last_used >= idle_timeout:
+                    del self._hosts[key]
+                    if entry.ssh is not None:
+                        entry.ssh.close()
+            remaining = len(self._hosts)
+            if not remaining:
+                self._reaper = None
+            return remaining
+
+    def close(self):
+        """Close all idle transports."""
+        self.evict(idle_timeout=0)
+
+
+class _SSHHost(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ssh = None
+        self.users = 0
+        self.last_used = time.time()
+
+
+_pkeys = {}
+_pkeys_lock = threading.Lock()
+
+
+def _load_pkey(pkey):
+    """Parse a base64-encoded RSA private key, caching the result per process."""
+    with _pkeys_lock:
+        key = _pkeys.get(pkey)
+    if key is None:
+        key = paramiko.RSAKey(file_obj=cStringIO.StringIO(base64.b64decode(pkey)))
+        with _pkeys_lock:
+            _pkeys[pkey] = key
+    return key
+
+
+def _ssh_exec(tran, cmd):
+    """Run `cmd` in a new session on `tran` and return its exit status and output."""
+    chan = tran.open_session()
+    # get a pty so stdout/stderr look right
+    chan.get_pty()
+    out = chan.makefile()
+    chan.exec_command(cmd)
+    rc, output = chan.recv_exit_status(), out.read()
+    return rc, output
+
+
+class WaitPolicy(object):
+    """Delays used when polling for something that is expected to change.
+
+    The first poll happens after `first` seconds. Each following delay grows by
+    `factor` up to `ceiling`, randomized by +/- `jitter` (a fraction) so that many
+    waiters do not poll in lockstep.
+    """
+
+    def __init__(self, first=WAIT_FIRST, factor=WAIT_FACTOR, ceiling=WAIT_CEILING,
+                 jitter=WAIT_JITTER):
+        self.first = first
+        self.factor = factor
+        self.ceiling = ceiling
+        self.jitter = jitter
+
+    @classmethod
+    def from_options(cls, options):
+        """Build a policy from the ``wait_*`` keys of SCHEDULER_OPTIONS."""
+        return cls(first=float(options.get('wait_first', WAIT_FIRST)),
+                   factor=float(options.get('wait_factor', WAIT_FACTOR)),
+                   ceiling=float(options.get('wait_ceiling', WAIT_CEILING)),
+                   jitter=float(options.get('wait_jitter', WAIT_JITTER)))
+
+    def __eq__(self, other):
+        return (isinstance(other, WaitPolicy) and
+                vars(self) == vars(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def next(self, delay):
+        """Return the delay to use after `delay`."""
+        return min(delay * self.factor, self.ceiling)
+
+    def jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def delays(self, deadline):
+        """Yield jittered delays until `deadline` seconds have passed."""
+        end = time.time() + deadline
+        delay = self.first
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            yield min(remaining, self.jittered(delay))
+            delay = self.next(delay)
+
+
+def _fetch_states(pool):
+    """Return the state of every unit in fleet, keyed by container name."""
+    headers = {'Content-Type': 'application/json'}
+    states = {}
+    url = '/v1-alpha/state'
+    while True:
+        resp, data = pool.request('GET', url, headers=headers)
+        if resp.status not in (200,):
+            errmsg = "Failed to retrieve state: {} {} - {}".format(
+                resp.status, resp.reason, data)
+            raise RuntimeError(errmsg)
+        page = json.loads(data)
+        for state in page.get('states', []):
+            states[state['name'].rsplit('.service', 1)[0]] = state
+        token = page.get('nextPageToken')
+        if not token:
+            return states
+        url = '/v1-alpha/state?nextPageToken={}'.format(token)
+
+
+class UnitStatePoller(object):
+    """Poll fleet for the state of every unit and wake up the threads watching them.
+
+    While at least one thread is watching, a single background thread fetches the
+    full ``/v1-alpha/state`` and notifies all watchers, so the request rate against
+    fleet does not grow with the number of containers. Polling follows a
+    :class:`WaitPolicy`: it starts quickly whenever a new watcher arrives and backs
+    off while everyone keeps waiting.
+    """
+
+    def __init__(self, pool, policy=None):
+        self.pool = pool
+        self.policy = policy or WaitPolicy()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._watchers = 0
+        self._delay = self.policy.first
+        self._next_poll = 0
+        # sequence numbers of the last fetch started and the snapshot we hold
+        self._started = 0
+        self._seq = 0
+        self._states = {}
+        self._error = None
+        self._failures = 0
+
+    def _fetch(self):
+        return _fetch_states(self.pool)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if not self._watchers:
+                        self._thread = None
+                        return
+                    remaining = self._next_poll - time.time()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                self._started += 1
+                seq = self._started
+            try:
+                states, error = self._fetch(), None
+            except Exception as e:
+                states, error = None, e
+            with self._lock:
+                if error is None:
+                    self._states = states
+                    self._failures = 0
+                else:
+                    self._failures += 1
+                self._error = error
+                self._seq = seq
+                self._next_poll = time.time() + self.policy.jittered(self._delay)
+                self._delay = self.policy.next(self._delay)
+                self._cond.notify_all()
+
+    def watch(self, name, timeout):
+        """Yield the state of unit `name` from each new snapshot for up to `timeout` seconds.
+
+        Only snapshots fetched after watching began are considered, and the unit's state
+        is None once it no longer exists in fleet.
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            self._watchers += 1
+            wanted = self._started + 1
+            # poll soon on behalf of the new watcher, then back off again
+            self._delay = self.policy.first
+            self._next_poll = min(self._next_poll, time.time() + self.policy.first)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                self._wakeup.notify()
+        try:
+            while True:
+                with self._lock:
+                    while self._seq < wanted:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return
+                        self._cond.wait(remaining)
+                    wanted = self._seq + 1
+                    if self._failures >= RETRIES:
+                        raise RuntimeError(self._error)
+                    state = self._states.get(name)
+                yield state
+        finally:
+            with self._lock:
+                self._watchers -= 1
+                if not self._watchers:
+                    # let the polling thread exit instead of sleeping until its next poll
+                    self._wakeup.notify()
+
+
+class MachineCache(object):
+    """A thread-safe cache of the fleet machine inventory, indexed by machine id.
+
+    The inventory is fetched at most once per `ttl` seconds, or sooner when a
+    lookup misses, so that a machine which just joined the cluster is found.
+    Concurrent refreshes are coalesced into a single fetch.
+    """
+
+    def __init__(self, pool, ttl=MACHINE_TTL):
+        self.pool = pool
+        self.ttl = ttl
+        self._machines = {}
+        self._fetched = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _fetch(self):
+        headers = {'Content-Type': 'application/json'}
+        machines = {}
+        url = '/v1-alpha/machines'
+        while True:
+            resp, data = self.pool.request('GET', url, headers=headers)
+            if resp.status not in (200,):
+                errmsg = "Failed to retrieve machines: {} {} - {}".format(
+                    resp.status, resp.reason, data)
+                raise RuntimeError(errmsg)
+            page = json.loads(data)
+            for machine in page.get('machines', []):
+                machines[machine['id']] = machine
+            token = page.get('nextPageToken')
+            if not token:
+                return machines
+            url = '/v1-alpha/machines?nextPageToken={}'.format(token)
+
+    def refresh(self, since=None):
+        """Fetch the inventory, unless another thread has done so after `since`."""
+        with self._refresh_lock:
+            with self._lock:
+                if since is not None and self._fetched is not None and self._fetched > since:
+                    return
+            started = time.time()
+            machines = self._fetch()
+            with self._lock:
+                self._machines, self._fetched = machines, started
+
+    def _current(self):
+        now = time.time()
+        with self._lock:
+            fresh = self._fetched is not None and now - self._fetched < self.ttl
+        if not fresh:
+            self.refresh(since=now - self.ttl)
+        return now
+
+    def get(self, machine_id):
+        """Return the machine with `machine_id`, or None if fleet does not know it."""
+        asked = self._current()
+        with self._lock:
+            machine = self._machines.get(machine_id)
+        if machine is None:
+            self.refresh(since=asked)
+            with self._lock:
+                machine = self._machines.get(machine_id)
+        return machine
+
+    def machines(self):
+        """Return a list of all known machines."""
+        self._current()
+        with self._lock:
+            return self._machines.values()
+
+    def metadata(self):
+        """Return a dict mapping each metadata key to the set of values machines offer."""
+        metadata = collections.defaultdict(set)
+        for machine in self.machines():
+            for key, value in (machine.get('metadata') or {}).items():
+                metadata[key].add(value)
+        return dict(metadata)
+
+
+class UnitTemplateCache(object):
+    """A thread-safe LRU cache of compiled unit templates.
+
+    Containers of the same release and process type share a compiled unit, so
+    creating many of them only substitutes the container name into each one.
+    """
+
+    def __init__(self, size=TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self._units = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compile):
+        """Return the unit compiled for `key`, calling `compile()` on a miss."""
+        with self._lock:
+            unit = self._units.pop(key, None)
+            if unit is not None:
+                self._units[key] = unit
+                return unit
+        unit = compile()
+        with self._lock:
+            self._units[key] = unit
+            while len(self._units) > self.size:
+                self._units.popitem(last=False)
+        return unit
+
+
+# template fields that are derived from the container name
+_NAME_FIELDS = ('name', 'app', 'version', 'c_type', 'c_num')
+
+
+def _placeholder(field):
+    return '\0{}\0'.format(field)
+
+
+def _render(value, fields):
+    """Substitute the container name fields into a compiled unit option."""
+    for field in _NAME_FIELDS:
+        value = value.replace(_placeholder(field), '{}'.format(fields[field]))
+    return value
+
+
+_unit_templates = UnitTemplateCache()
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def _get_shared(cls, path, *args):
+    """Return the `cls` instance shared by all clients of the fleet socket at `path`.
+
+    The instance is rebuilt when `args` differ from the ones it was built with, so
+    clients created after SCHEDULER_OPTIONS change pick up the new values. Idle
+    connections of a replaced instance are closed right away; clients still using
+    it keep working and open new connections as needed.
+    """
+    with _shared_lock:
+        built = _shared.get((cls, path))
+        if built is None or built[0] != args:
+            replaced = built
+            built = _shared[(cls, path)] = (args, cls(*args))
+            if replaced is not None and hasattr(replaced[1], 'close'):
+                replaced[1].close()
+        return built[1]
+
+
 class FleetHTTPClient(object):
 
     def __init__(self, target, auth, options, pkey):
@@ -35,17 +564,40 @@ class FleetHTTPClient(object):
         self.auth = auth
         self.options = options
         self.pkey = pkey
-        # single global connection
-        self.conn = UHTTPConnection(self.target)
+        # connections and state polling are shared between clients of one fleet socket
+        self.pool = _get_shared(UHTTPConnectionPool, self.target, self.target,
+                                int(options.get('pool_size', POOL_SIZE)),
+                                float(options.get('pool_idle_timeout', POOL_IDLE_TIMEOUT)))
+        self.policy = WaitPolicy.from_options(options)
+        self.poll_policy = self.policy
+        if 'poll_interval' in options:
+            # poll unit states at a fixed rate instead of backing off
+            interval = float(options['poll_interval'])
+            self.poll_policy = WaitPolicy(first=interval, factor=1, ceiling=interval, jitter=0)
+        self.poller = _get_shared(UnitStatePoller, self.target, self.pool, self.poll_policy)
+        self.machines = _get_shared(MachineCache, self.target, self.pool,
+                                    float(options.get('machine_ttl', MACHINE_TTL)))
+        self.ssh = _get_shared(SSHTransportPool, self.target,
+                               float(options.get('ssh_keepalive', SSH_KEEPALIVE)),
+                               float(options.get('ssh_idle_timeout', SSH_IDLE_TIMEOUT)))
+        self.timeouts = {
+            'start': float(options.get('start_timeout', START_TIMEOUT)),
+            'destroy': float(options.get('destroy_timeout', DESTROY_TIMEOUT)),
+            'schedule': float(options.get('schedule_timeout', SCHEDULE_TIMEOUT)),
+            'run': float(options.get('run_timeout', RUN_TIMEOUT)),
+        }
+
+    def close(self):
+        """Close the idle fleet and SSH connections of this client."""
+        self.pool.close()
+        self.ssh.close()
 
     # connection helpers
 
     def _put_unit(self, name, body):
         headers = {'Content-Type': 'application/json'}
-        self.conn.request('PUT', '/v1-alpha/units/{name}.service'.format(**locals()),
-                          headers=headers, body=json.dumps(body))
-        resp = self.conn.getresponse()
-        data = resp.read()
+        resp, data = self.pool.request('PUT', '/v1-alpha/units/{name}.service'.format(**locals()),
+                                       headers=headers, body=json.dumps(body))
         if not 200 <= resp.status <= 299:
             errmsg = "Failed to create unit: {} {} - {}".format(
                 resp.status, resp.reason, data)
@@ -54,10 +606,9 @@ class FleetHTTPClient(object):
 
     def _delete_unit(self, name):
         headers = {'Content-Type': 'application/json'}
-        self.conn.request('DELETE', '/v1-alpha/units/{name}.service'.format(**locals()),
-                          headers=headers)
-        resp = self.conn.getresponse()
-        data = resp.read()
+        resp, data = self.pool.request('DELETE',
+                                       '/v1-alpha/units/{name}.service'.format(**locals()),
+                                       headers=headers)
         if resp.status not in (404, 204):
             errmsg = "Failed to delete unit: {} {} - {}".format(
                 resp.status, resp.reason, data)
@@ -69,102 +620,140 @@ class FleetHTTPClient(object):
         url = '/v1-alpha/state'
         if name:
             url += '?unitName={name}.service'.format(**locals())
-        self.conn.request('GET', url, headers=headers)
-        resp = self.conn.getresponse()
-        data = resp.read()
+        resp, data = self.pool.request('GET', url, headers=headers)
         if resp.status not in (200,):
             errmsg = "Failed to retrieve state: {} {} - {}".format(
                 resp.status, resp.reason, data)
             raise RuntimeError(errmsg)
         return json.loads(data)
 
-    def _get_machines(self):
-        headers = {'Content-Type': 'application/json'}
-        url = '/v1-alpha/machines'
-        self.conn.request('GET', url, headers=headers)
-        resp = self.conn.getresponse()
-        data = resp.read()
-        if resp.status not in (200,):
-            errmsg = "Failed to retrieve machines: {} {} - {}".format(
-                resp.status, resp.reason, data)
-            raise RuntimeError(errmsg)
-        return json.loads(data)
+    def states(self):
+        """Return the state of every container fleet knows about, keyed by name.
+
+        States are "up", "down" or "crashed", or None for a unit that is still
+        changing state. The whole inventory is fetched at once.
+        """
+        return {name: UNIT_STATES.get(state.get('systemdSubState'))
+                for name, state in _fetch_states(self.pool).items()}
+
+    def machine_metadata(self):
+        """Return a dict mapping each machine metadata key to the values offered."""
+        return self.machines.metadata()
 
     # container api
 
     def create(self, name, image, command='', template=None, **kwargs):
         """Create a container"""
-        self._create_container(name, image, command,
-                               template or copy.deepcopy(CONTAINER_TEMPLATE), **kwargs)
+        self._create_container(name, image, command, template or CONTAINER_TEMPLATE, **kwargs)
 
     def _create_container(self, name, image, command, unit, **kwargs):
-        l = locals().copy()
-        l.update(re.match(MATCH, name).groupdict())
+        unit = self._build_unit(name, image, command, unit, **kwargs)
+        # post unit to fleet and retry
+        for attempt in range(RETRIES):
+            try:
+                self._put_unit(name, {"desiredState": "launched", "options": unit})
+                break
+            except Exception as e:
+                if attempt == (RETRIES - 1):  # account for 0 indexing
+                    raise
+                logger.warning('{}: create failed, retrying: {}'.format(name, e))
+                metrics.retry('create', name, e)
+
+    def _build_unit(self, name, image, command, template, **kwargs):
+        fields = MATCH.match(name).groupdict()
+        c_type = fields['c_type']
+        memory = kwargs.get('memory', {}).get(c_type, None)
+        cpu = kwargs.get('cpu', {}).get(c_type, None)
+        tags = kwargs.get('tags', {})
+        entrypoint = kwargs.get('entrypoint')
+        key = (_TEMPLATE_KEYS.get(id(template)) or
+               tuple((f['section'], f['name'], f['value']) for f in template),
+               image, command, memory, cpu, tuple(sorted(tags.items())), entrypoint)
+        unit = _unit_templates.get(key, lambda: self._compile_unit(
+            template, image, command, memory, cpu, tags, entrypoint))
+        # only the parts derived from the container name differ between containers
+        fields['name'] = name
+        return [{'section': section, 'name': option,
+                 'value': _render(value, fields) if per_name else value}
+                for section, option, value, per_name in unit]
+
+    def _compile_unit(self, template, image, command, memory, cpu, tags, entrypoint):
+        """Render `template` for everything except the fields taken from the container name.
+
+        Those fields are left as placeholders for :func:`_render`.
+        """
+        l = {f: _placeholder(f) for f in _NAME_FIELDS}
+        l.update({'image': image, 'command': command})
         # prepare memory limit for the container type
-        mem = kwargs.get('memory', {}).get(l['c_type'], None)
-        if mem:
-            l.update({'memory': '-m {}'.format(mem.lower())})
+        if memory:
+            l.update({'memory': '-m {}'.format(memory.lower())})
         else:
             l.update({'memory': ''})
-        # prepare memory limit for the container type
-        cpu = kwargs.get('cpu', {}).get(l['c_type'], None)
+        # prepare cpu limit for the container type
         if cpu:
             l.update({'cpu': '-c {}'.format(cpu)})
         else:
             l.update({'cpu': ''})
         # should a special entrypoint be used
-        entrypoint = kwargs.get('entrypoint')
         if entrypoint:
             l.update({'entrypoint': '{}'.format(entrypoint)})
         # construct unit from template
-        for f in unit:
-            f['value'] = f['value'].format(**l)
+        unit = []
+        for f in template:
+            value = f['value'].format(**l)
+            unit.append((f['section'], f['name'], value, '\0' in value))
         # prepare tags only if one was provided
-        tags = kwargs.get('tags', {})
         if tags:
             tagset = ' '.join(['"{}={}"'.format(k, v) for k, v in tags.items()])
-            unit.append({"section": "X-Fleet", "name": "MachineMetadata",
-                         "value": tagset})
-        # post unit to fleet and retry
-        for attempt in range(RETRIES):
-            try:
-                self._put_unit(name, {"desiredState": "launched", "options": unit})
-                break
-            except:
-                if attempt == (RETRIES - 1):  # account for 0 indexing
-                    raise
+            unit.append(("X-Fleet", "MachineMetadata", tagset, False))
+        return tuple(unit)
 
     def start(self, name):
         """Start a container"""
         self._wait_for_container(name)
 
+    def _log_phases(self, name, phases):
+        """Report how long a container spent in each wait phase."""
+        logger.info('{}: {}'.format(name, ', '.join(
+            '{} after {:.2f}s'.format(phase, elapsed) for phase, elapsed in phases)))
+
     def _wait_for_container(self, name):
-        failures = 0
-        # we bump to 20 minutes here to match the timeout on the router and in the app unit files
-        for _ in range(1200):
-            states = self._get_state(name)
-            if states and len(states.get('states', [])) == 1:
-                state = states.get('states')[0]
+        began, failed_since, phases = time.time(), None, []
+        with contextlib.closing(self.poller.watch(name, self.timeouts['start'])) as states:
+            for state in states:
+                metrics.poll('start', name)
+                if state is None:
+                    continue
+                if not phases:
+                    phases.append(('scheduled', time.time() - began))
                 subState = state.get('systemdSubState')
                 if subState == 'running' or subState == 'exited':
-                    break
+                    phases.append((subState, time.time() - began))
+                    self._log_phases(name, phases)
+                    return
                 elif subState == 'failed':
                     # FIXME: fleet unit state reports failed when containers are fine
-                    failures += 1
-                    if failures == 10:
+                    failed_since = failed_since or time.time()
+                    if time.time() - failed_since >= FAILED_GRACE:
+                        phases.append(('failed', time.time() - began))
+                        self._log_phases(name, phases)
                         raise RuntimeError('container failed to start')
-            time.sleep(1)
-        else:
-            raise RuntimeError('container timeout on start')
+                else:
+                    failed_since = None
+        phases.append(('timed out', time.time() - began))
+        self._log_phases(name, phases)
+        raise RuntimeError('container timeout on start')
 
     def _wait_for_destroy(self, name):
-        for _ in range(30):
-            states = self._get_state(name)
-            if not states:
-                break
-            time.sleep(1)
-        else:
-            raise RuntimeError('timeout on container destroy')
+        began = time.time()
+        with contextlib.closing(self.poller.watch(name, self.timeouts['destroy'])) as states:
+            for state in states:
+                metrics.poll('destroy', name)
+                if state is None:
+                    self._log_phases(name, [('destroyed', time.time() - began)])
+                    return
+        self._log_phases(name, [('timed out', time.time() - began)])
+        raise RuntimeError('timeout on container destroy')
 
     def stop(self, name):
         """Stop a container"""
@@ -175,8 +764,8 @@ class FleetHTTPClient(object):
         # call all destroy functions, ignoring any errors
         try:
             self._destroy_container(name)
-        except:
-            pass
+        except Exception as e:
+            logger.warning('{}: could not delete unit: {}'.format(name, e))
         self._wait_for_destroy(name)
 
     def _destroy_container(self, name):
@@ -184,99 +773,124 @@ class FleetHTTPClient(object):
             try:
                 self._delete_unit(name)
                 break
-            except:
+            except Exception as e:
                 if attempt == (RETRIES - 1):  # account for 0 indexing
                     raise
+                logger.warning('{}: destroy failed, retrying: {}'.format(name, e))
+                metrics.retry('destroy', name, e)
 
-    def run(self, name, image, entrypoint, command):  # noqa
+    def run(self, name, image, entrypoint, command):
         """Run a one-off command"""
-        self._create_container(name, image, command, copy.deepcopy(RUN_TEMPLATE),
-                               entrypoint=entrypoint)
+        began, phases = time.time(), []
+        host = self._schedule_run(name, image, entrypoint, command, began, phases)
+
+        # grab output via docker logs over a pooled SSH transport
+        with self.ssh.transport(host, _load_pkey(self.pkey)) as tran:
+            self._wait_for_run_start(tran, name, began, phases)
+            self._wait_for_run_exit(tran, name, began, phases)
+            self._log_phases(name, phases)
+
+            # gather container output
+            _rc, output = _ssh_exec(tran, 'docker logs {name}'.format(**locals()))
+            if _rc != 0:
+                raise RuntimeError('could not attach to container')
+            rc = self._run_exit_code(tran, name)
+
+        # cleanup
+        self._destroy_container(name)
+        self._wait_for_destroy(name)
+
+        # return rc and output
+        return rc, output
+
+    def run_stream(self, name, image, entrypoint, command):
+        """Run a one-off command, yielding its output as it arrives.
+
+        Output chunks are yielded as strings while the command runs, followed by
+        the integer exit code once it has finished. The container is destroyed
+        when the generator is exhausted or closed early.
+        """
+        began, phases = time.time(), []
+        host = self._schedule_run(name, image, entrypoint, command, began, phases)
+        try:
+            with self.ssh.transport(host, _load_pkey(self.pkey)) as tran:
+                self._wait_for_run_start(tran, name, began, phases)
+
+                # follow container output until the command exits
+                chan = tran.open_session()
+                chan.get_pty()
+                chan.exec_command('docker logs -f {name}'.format(**locals()))
+                try:
+                    for data in iter(lambda: chan.recv(RUN_CHUNK_SIZE), ''):
+                        yield data
+                    if chan.recv_exit_status() != 0:
+                        raise RuntimeError('could not attach to container')
+                finally:
+                    chan.close()
+
+                self._wait_for_run_exit(tran, name, began, phases)
+                self._log_phases(name, phases)
+                rc = self._run_exit_code(tran, name)
+        finally:
+            self._destroy_container(name)
+            self._wait_for_destroy(name)
+        yield rc
+
+    def _schedule_run(self, name, image, entrypoint, command, began, phases):
+        """Create a one-off container and return the address of the host it lands on."""
+        self._create_container(name, image, command, RUN_TEMPLATE, entrypoint=entrypoint)
 
         # wait for the container to get scheduled
-        for _ in range(30):
-            states = self._get_state(name)
-            if states and len(states.get('states', [])) == 1:
-                state = states.get('states')[0]
-                break
-            time.sleep(1)
-        else:
-            raise RuntimeError('container did not report state')
+        with contextlib.closing(self.poller.watch(name, self.timeouts['schedule'])) as states:
+            for state in states:
+                if state is not None:
+                    break
+            else:
+                raise RuntimeError('container did not report state')
+        phases.append(('scheduled', time.time() - began))
         machineID = state.get('machineID')
 
-        # find the machine
-        machines = self._get_machines()
-        if not machines:
-            raise RuntimeError('no available hosts to run command')
-
         # find the machine's primaryIP
-        primaryIP = None
-        for m in machines.get('machines', []):
-            if m['id'] == machineID:
-                primaryIP = m['primaryIP']
+        machine = self.machines.get(machineID)
+        if machine is None and not self.machines.machines():
+            raise RuntimeError('no available hosts to run command')
+        primaryIP = machine and machine.get('primaryIP')
         if not primaryIP:
             raise RuntimeError('could not find host')
+        return primaryIP
 
-        # prepare ssh key
-        file_obj = cStringIO.StringIO(base64.b64decode(self.pkey))
-        pkey = paramiko.RSAKey(file_obj=file_obj)
-
-        # grab output via docker logs over SSH
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(primaryIP, username="core", pkey=pkey)
-        # share a transport
-        tran = ssh.get_transport()
-
-        def _do_ssh(cmd):
-            chan = tran.open_session()
-            # get a pty so stdout/stderr look right
-            chan.get_pty()
-            out = chan.makefile()
-            chan.exec_command(cmd)
-            rc, output = chan.recv_exit_status(), out.read()
-            return rc, output
-
-        # wait for container to start
-        for _ in range(1200):
-            rc, _ = _do_ssh('docker inspect {name}'.format(**locals()))
+    def _wait_for_run_start(self, tran, name, began, phases):
+        for delay in self.policy.delays(self.timeouts['start']):
+            metrics.poll('run', name)
+            rc, _ = _ssh_exec(tran, 'docker inspect {name}'.format(**locals()))
             if rc == 0:
                 break
-            time.sleep(1)
+            time.sleep(delay)
         else:
             raise RuntimeError('container failed to start on host')
+        phases.append(('started', time.time() - began))
 
-        # wait for container to complete
-        for _ in range(1200):
-            _rc, _output = _do_ssh('docker inspect {name}'.format(**locals()))
+    def _wait_for_run_exit(self, tran, name, began, phases):
+        for delay in self.policy.delays(self.timeouts['run']):
+            metrics.poll('run', name)
+            _rc, _output = _ssh_exec(tran, 'docker inspect {name}'.format(**locals()))
             if _rc != 0:
                 raise RuntimeError('failed to inspect container')
             _container = json.loads(_output)
             finished_at = _container[0]["State"]["FinishedAt"]
             if not finished_at.startswith('0001'):
                 break
-            time.sleep(1)
+            time.sleep(delay)
         else:
             raise RuntimeError('container timed out')
+        phases.append(('finished', time.time() - began))
 
-        # gather container output
-        _rc, output = _do_ssh('docker logs {name}'.format(**locals()))
-        if _rc != 0:
-            raise RuntimeError('could not attach to container')
-
-        # determine container exit code
-        _rc, _output = _do_ssh('docker inspect {name}'.format(**locals()))
+    def _run_exit_code(self, tran, name):
+        _rc, _output = _ssh_exec(tran, 'docker inspect {name}'.format(**locals()))
         if _rc != 0:
             raise RuntimeError('could not determine exit code')
         container = json.loads(_output)
-        rc = container[0]["State"]["ExitCode"]
-
-        # cleanup
-        self._destroy_container(name)
-        self._wait_for_destroy(name)
-
-        # return rc and output
-        return rc, output
+        return container[0]["State"]["ExitCode"]
 
     def attach(self, name):
         """
@@ -306,3 +920,6 @@ RUN_TEMPLATE = [
     {"section": "Service", "name": "ExecStart", "value": '''/bin/sh -c "IMAGE=$(etcdctl get /deis/registry/host 2>&1):$(etcdctl get /deis/registry/port 2>&1)/{image}; docker run --name {name} --entrypoint={entrypoint} -a stdout -a stderr $IMAGE {command}"'''},  # noqa
     {"section": "Service", "name": "TimeoutStartSec", "value": "20m"},
 ]
+
+# stable cache keys for the built-in templates
+_TEMPLATE_KEYS = {id(CONTAINER_TEMPLATE): 'container', id(RUN_TEMPLATE): 'run'}
@@ -0,0 +1,344 @@
+"""
+Latency and error instrumentation for scheduler clients.
+
+:class:`InstrumentedSchedulerClient` wraps the client of any scheduler module
+and records each operation in a process-wide :class:`Metrics` registry, tagged
+by the app and process type parsed from the container name. Schedulers report
+retries and poll iterations to the same registry.
+
+The registry only sees the operations of its own process. Given the URL of a
+Redis server, each process also publishes its statistics there, so that
+:meth:`Metrics.aggregate` can combine those of every web and job worker.
+"""
+
+import bisect
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+# distinct failure reasons kept per operation before they are lumped together
+MAX_REASONS = 20
+# default interval (seconds) between log summaries
+METRICS_INTERVAL = 300
+# interval (seconds) between publishing the statistics of a process to Redis; those
+# of a process that stopped publishing are dropped after STALE_AFTER intervals
+PUBLISH_INTERVAL = 10
+STALE_AFTER = 3
+PUBLISH_KEY = 'deis:scheduler:metrics'
+
+OPERATIONS = ('create', 'start', 'stop', 'destroy', 'run')
+
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Count observed values in fixed buckets, along with their count, sum and max."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the `q` quantile."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'mean': round(self.sum / self.count, 3) if self.count else 0,
+            'max': round(self.max, 3),
+            'buckets': collections.OrderedDict(zip(bounds, self.counts)),
+        }
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.retries = 0
+        self.polls = 0
+        self.failures = collections.Counter()
+
+    def fail(self, error):
+        reason = '{}: {}'.format(type(error).__name__, error)[:200]
+        if reason not in self.failures and len(self.failures) >= MAX_REASONS:
+            reason = 'other'
+        self.failures[reason] += 1
+
+
+class Metrics(object):
+    """A thread-safe registry of scheduler operation statistics.
+
+    Statistics are kept per operation, app and process type. Every method that
+    records something takes the container name the operation applies to.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._changed = False
+        self._reporter = None
+        self._publisher = None
+        self._redis = {}
+
+    def _get(self, operation, name):
+        from scheduler.fleet import MATCH
+        match = MATCH.match(name or '')
+        app, c_type = match.group('app', 'c_type') if match else (None, None)
+        key = (operation, app, c_type)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _Stats()
+        self._changed = True
+        return stats
+
+    def observe(self, operation, name, seconds, error=None):
+        """Record that `operation` on container `name` took `seconds` and how it ended."""
+        with self._lock:
+            stats = self._get(operation, name)
+            stats.latency.observe(seconds)
+            if error is not None:
+                stats.errors += 1
+                stats.fail(error)
+
+    def retry(self, operation, name, error):
+        """Record that `operation` on container `name` is retried after `error`."""
+        with self._lock:
+            stats = self._get(operation, name)
+            stats.retries += 1
+            stats.fail(error)
+
+    def poll(self, operation, name, count=1):
+        """Record `count` state polls while waiting for `operation` on container `name`."""
+        with self._lock:
+            self._get(operation, name).polls += count
+
+    def snapshot(self):
+        """Return the statistics as a list of dicts, ready to be serialized."""
+        with self._lock:
+            return [{
+                'operation': operation,
+                'app': app,
+                'type': c_type,
+                'latency': stats.latency.as_dict(),
+                'errors': stats.errors,
+                'retries': stats.retries,
+                'polls': stats.polls,
+                'failures': dict(stats.failures),
+            } for (operation, app, c_type), stats in sorted(self._stats.items())]
+
+    def summary(self):
+        """Return one line of text per operation, app and process type."""
+        with self._lock:
+            return [
+                '{} {}/{}: {} calls, {} errors, {} retries, {} polls, '
+                'mean {:.2f}s, p90 {}s, max {:.2f}s'.format(
+                    operation, app, c_type, stats.latency.count, stats.errors, stats.retries,
+                    stats.polls, stats.latency.sum / (stats.latency.count or 1),
+                    stats.latency.quantile(0.9), stats.latency.max)
+                for (operation, app, c_type), stats in sorted(self._stats.items())]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def _shared(self, url):
+        client = self._redis.get(url)
+        if client is None:
+            import redis
+            client = self._redis[url] = redis.StrictRedis.from_url(url)
+        return client
+
+    @staticmethod
+    def _process():
+        # computed on each use, since workers are forked after this module is loaded
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def publish(self, url):
+        """Publish the statistics of this process to the Redis server at `url`."""
+        data = json.dumps({'time': time.time(), 'operations': self.snapshot()})
+        self._shared(url).hset(PUBLISH_KEY, self._process(), data)
+
+    def share(self, url, interval=PUBLISH_INTERVAL):
+        """Publish the statistics of this process to Redis every `interval` seconds."""
+        with self._lock:
+            if not url or (self._publisher is not None and self._publisher.is_alive()):
+                return
+            self._publisher = threading.Thread(target=self._publish, args=(url, interval),
+                                               name='scheduler-metrics-publisher')
+            self._publisher.daemon = True
+            self._publisher.start()
+
+    def _publish(self, url, interval):
+        while True:
+            try:
+                self.publish(url)
+            except Exception as e:
+                logger.warning('could not publish scheduler metrics: {}'.format(e))
+            time.sleep(interval)
+
+    def aggregate(self, url='', interval=PUBLISH_INTERVAL):
+        """Return the statistics of every process publishing to `url`, combined.
+
+        Without `url`, or when Redis cannot be reached, only the statistics of this
+        process are returned. This process is always counted as of now.
+        """
+        snapshots = [self.snapshot()]
+        if not url:
+            return snapshots[0]
+        try:
+            published = self._shared(url).hgetall(PUBLISH_KEY)
+            oldest, stale = time.time() - interval * STALE_AFTER, []
+            for process, data in published.items():
+                data = json.loads(data, object_pairs_hook=collections.OrderedDict)
+                if data['time'] < oldest:
+                    stale.append(process)
+                elif process != self._process():
+                    snapshots.append(data['operations'])
+            if stale:
+                self._shared(url).hdel(PUBLISH_KEY, *stale)
+        except Exception as e:
+            logger.warning('could not aggregate scheduler metrics: {}'.format(e))
+            return snapshots[0]
+        return _combine(snapshots)
+
+    def start_reporter(self, interval=METRICS_INTERVAL):
+        """Log a summary every `interval` seconds in which something was recorded."""
+        with self._lock:
+            if self._reporter is not None or not interval:
+                return
+            self._reporter = threading.Thread(target=self._report, args=(interval,),
+                                              name='scheduler-metrics')
+            self._reporter.daemon = True
+            self._reporter.start()
+
+    def _report(self, interval):
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                changed, self._changed = self._changed, False
+            if changed:
+                for line in self.summary():
+                    logger.info(line)
+
+
+def _combine(snapshots):
+    """Add up lists of statistics as returned by :meth:`Metrics.snapshot`."""
+    combined = {}
+    for snapshot in snapshots:
+        for stats in snapshot:
+            key = (stats['operation'], stats['app'], stats['type'])
+            total = combined.get(key)
+            if total is None:
+                combined[key] = json.loads(json.dumps(stats),
+                                           object_pairs_hook=collections.OrderedDict)
+                continue
+            for field in ('errors', 'retries', 'polls'):
+                total[field] += stats[field]
+            for reason, count in stats['failures'].items():
+                total['failures'][reason] = total['failures'].get(reason, 0) + count
+            latency = total['latency']
+            latency['count'] += stats['latency']['count']
+            latency['sum'] = round(latency['sum'] + stats['latency']['sum'], 3)
+            latency['max'] = max(latency['max'], stats['latency']['max'])
+            latency['mean'] = round(latency['sum'] / latency['count'], 3) \
+                if latency['count'] else 0
+            for bound, count in stats['latency']['buckets'].items():
+                latency['buckets'][bound] += count
+    return [combined[k] for k in sorted(combined)]
+
+
+metrics = Metrics()
+
+
+class InstrumentedSchedulerClient(object):
+    """Wrap a scheduler client and record the latency and outcome of its operations.
+
+    Batch methods (e.g. ``create_many``) are recorded once per container, with the
+    duration of the whole batch. Any other attribute is passed through untouched,
+    so a wrapped client supports exactly the methods of the client it wraps. The
+    registry is published to the Redis server at `share_url`, if given.
+    """
+
+    def __init__(self, client, registry=metrics, share_url=''):
+        self._client = client
+        self._metrics = registry
+        options = getattr(client, 'options', None) or {}
+        registry.start_reporter(float(options.get('metrics_interval', METRICS_INTERVAL)))
+        registry.share(share_url)
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr in OPERATIONS:
+            return self._timed(attr, value)
+        if attr.endswith('_many') and attr[:-len('_many')] in OPERATIONS:
+            return self._timed_batch(attr[:-len('_many')], value)
+        if attr == 'run_stream':
+            return self._timed_stream(value)
+        return value
+
+    def _timed(self, operation, method):
+        def timed(name, *args, **kwargs):
+            began = time.time()
+            try:
+                result = method(name, *args, **kwargs)
+            except Exception as e:
+                self._metrics.observe(operation, name, time.time() - began, e)
+                raise
+            self._metrics.observe(operation, name, time.time() - began)
+            return result
+        return timed
+
+    def _timed_batch(self, operation, method):
+        def timed(items, *args, **kwargs):
+            began, errors = time.time(), {}
+            names = [i['name'] if isinstance(i, dict) else i for i in items]
+            try:
+                errors = method(items, *args, **kwargs)
+            except Exception as e:
+                errors = dict.fromkeys(names, e)
+                raise
+            finally:
+                elapsed = time.time() - began
+                for name in names:
+                    self._metrics.observe(operation, name, elapsed, errors.get(name))
+            return errors
+        return timed
+
+    def _timed_stream(self, method):
+        def timed(name, *args, **kwargs):
+            began, error = time.time(), None
+            try:
+                for item in method(name, *args, **kwargs):
+                    yield item
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._metrics.observe('run', name, time.time() - began, error)
+        return timed
@@ -1,3 +1,5 @@
+import json
+
 # security keys and auth tokens
 SECRET_KEY = '{{ .deis_controller_secretKey }}'
 BUILDER_KEY = '{{ .deis_controller_builderKey }}'
@@ -6,7 +8,7 @@ BUILDER_KEY = '{{ .deis_controller_builderKey }}'
 SCHEDULER_MODULE = '{{ or (.deis_controller_schedulerModule) "fleet" }}'
 SCHEDULER_TARGET = '{{ or (.deis_controller_schedulerTarget) "/var/run/fleet.sock" }}'
 try:
-    SCHEDULER_OPTIONS = dict('{{ or (.deis_controller_schedulerOptions) "{}" }}')
+    SCHEDULER_OPTIONS = json.loads('{{ or (.deis_controller_schedulerOptions) "{}" }}')
 except:
     SCHEDULER_OPTIONS = {}
 
@@ -36,6 +38,8 @@ DATABASES = {
 
 # configure cache
 CACHE_URL = 'redis://{{ .deis_cache_host }}:{{ .deis_cache_port }}/0'
+REGISTRY_CACHE_URL = CACHE_URL
+SCHEDULER_METRICS_URL = CACHE_URL
 
 # move log directory out of /app/deis
 DEIS_LOG_DIR = '/var/log/deis'
@@ -44,6 +48,14 @@ DEIS_LOG_DIR = '/var/log/deis'
 REGISTRATION_ENABLED = bool({{ .deis_controller_registrationEnabled }})
 {{ end }}
 
+{{ if .deis_controller_asyncJobs }}
+ASYNC_JOBS = bool({{ .deis_controller_asyncJobs }})
+{{ end }}
+
+{{ if .deis_controller_reconcileInterval }}
+RECONCILE_INTERVAL = float({{ .deis_controller_reconcileInterval }})
+{{ end }}
+
 {{ if .deis_controller_webEnabled }}
 WEB_ENABLED = bool({{ .deis_controller_webEnabled }})
 {{ end }}